@@ -5,11 +5,34 @@ import os.path
 import re
 import struct
 import argparse
+import hashlib
+import json
+import shutil
+import tempfile
+import subprocess
+import shlex
+import copy
+import StringIO
+import multiprocessing
+import traceback
+import threading
+import Queue
+import time
+import itertools
+import array
+import binascii
+try:
+    import termios  # only needed by --send
+except ImportError:
+    termios = None
 
 
 srcs = {}
 filename = ''
 pos = 0
+warning_log = []
+output_suffixes = []
+incbin_files = set()
 
 def fatal(msg):
     prog = os.path.basename(sys.argv[0])
@@ -37,6 +60,7 @@ def warning(msg, show_line=False):
         print >> sys.stderr, '{}:{}: warning:'.format(filename, pos), msg
     if show_line:
         print >> sys.stderr, '  ' + srcs[filename][pos]
+    warning_log.append((filename, pos, msg, srcs[filename][pos] if show_line else None))
 
 
 # ----------------------------------------------------------------------
@@ -321,6 +345,18 @@ def on_dot_space(operands):
     size = int(operands[0], 0)
     return ''.ljust(size, chr(imm & 255))
 
+def on_dot_incbin(operands):
+    path, offset, length = operands[0], int(operands[1]), int(operands[2])
+    try:
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+    except IOError:
+        error('cannot read file: ' + path)
+    if len(data) != length:
+        error('file changed during assembly: ' + path)
+    return data
+
 def code(mnemonic, operands):
     if mnemonic in alu3_table:
         return on_alu3(operands, alu3_table[mnemonic])
@@ -358,6 +394,8 @@ def code(mnemonic, operands):
         return ''.join(on_dot_short(operand) for operand in operands)
     if mnemonic == '.space':
         return on_dot_space(operands)
+    if mnemonic == '.incbin':
+        return on_dot_incbin(operands)
     error('unknown mnemonic \'{}\''.format(mnemonic))
 
 
@@ -565,6 +603,64 @@ def expand_bfne(op, operands, pred):
     return [(c, ['r29', operands[0], operands[1]]),
             (b + pred, ['r29', 'r0', operands[2]])]
 
+# .switch reg, default, value:label, ...
+# Dense cases become a bounds check and a jump through an inline table of
+# labels, sparse ones a binary search over the sorted values; the form
+# with fewer instructions on the average path is used, as long as the
+# table would be at least a quarter full.
+def expand_dot_switch(operands):
+    if len(operands) < 2:
+        error('expected at least 2 operands, but {} given'.format(len(operands)))
+    reg, default = operands[:2]
+    if reg not in regs or reg == 'r29':
+        error('expected register other than r29: ' + reg)
+    cases = {}
+    for operand in operands[2:]:
+        value, sep, label = operand.partition(':')
+        success, imm = parse_int(value.strip())
+        if not sep or not success or not label.strip():
+            error('expected value:label: ' + operand)
+        if imm in cases:
+            error('duplicate case value: ' + value.strip())
+        cases[imm] = label.strip()
+    cases = sorted(cases.items())
+    name = 'switch${}'.format(pos)
+
+    def tree(lo, hi):
+        if hi - lo <= 3:
+            lines = []
+            total = 0
+            for value, label in cases[lo:hi]:
+                lines += [('beq', [reg, 'r0', label])] if value == 0 else expand_bne('beq', [reg, str(value), label], '')
+                total += len(lines)
+            return lines + [('jl', ['r29', default])], total
+        mid = (lo + hi) // 2
+        left = '{}${}_{}'.format(name, lo, mid)
+        test = expand_blt('blt', [reg, str(cases[mid][0]), left], '')
+        right_lines, right_total = tree(mid, hi)
+        left_lines, left_total = tree(lo, mid)
+        lines = test + right_lines + [(left + ':', [])] + left_lines
+        return lines, len(test) * (hi - lo) + right_total + left_total
+
+    lines, total = tree(0, len(cases))
+    if not cases:
+        return lines
+    low, high = cases[0][0], cases[-1][0]
+    if high - low + 1 > 4 * len(cases):
+        return lines
+    if low == 0:
+        check = expand_alu('cmpult', ['r29', reg, str(high + 1)]) + [('beq', ['r29', 'r0', default])]
+    else:
+        check = expand_blt('blt', [reg, str(low), default], '') + expand_blt('bgt', [reg, str(high), default], '')
+    jump = [('mov', ['r29', '{}{:+}'.format(name, -4 * low)]),
+            ('adda', ['r29', 'r29', reg, '0']),
+            ('ld', ['r29', 'r29', '0']),
+            ('jr', ['r29', 'r29'])]
+    if (len(check) + len(jump)) * len(cases) >= total:
+        return lines
+    table = dict(cases)
+    return check + jump + [(name + ':', []), ('.int', [table.get(value, default) for value in range(low, high + 1)])]
+
 def expand_push(operands):
     check_operands_n(operands, 1)
     pre = [('sub', ['rsp', 'rsp', 'r0', '4'])]
@@ -624,6 +720,17 @@ def expand_dot_space(operands):
         return [('.space', operands)]
     return [('.space', [operands[0], '0'])]
 
+# the file name is relative to the directory of the source file
+def expand_dot_incbin(operands):
+    check_operands_n(operands, 1, 3)
+    path = os.path.normpath(os.path.join(os.path.dirname(filename), eval_string(operands[0])))
+    def go(operand):
+        success, imm = parse_int(operand)
+        if not success or imm < 0:
+            error('expected non-negative integer literal: ' + operand)
+        return str(imm)
+    return [('.incbin', [path] + map(go, operands[1:]))]
+
 def expand_dot_string(operands):
     check_operands_n(operands, 1)
     s = eval_string(operands[0])
@@ -653,8 +760,10 @@ macro_table = {
     'leave':    expand_leave,
     'halt':     expand_halt,
     '.float':   expand_dot_float,
+    '.incbin':  expand_dot_incbin,
     '.space':   expand_dot_space,
     '.string':  expand_dot_string,
+    '.switch':  expand_dot_switch,
 }
 
 def expand_macro(line):
@@ -703,8 +812,15 @@ ofs_table = {
     'call':     32,
     'call6':    24,
     'call7':    28,
+    'jl2':       8,
+    'jl3':      12,
 }
 
+# relaxed branches (see relax_branches)
+for op, pred in itertools.product(['bne', 'beq'], ['', '-', '+']):
+    ofs_table[op + '3' + pred] = 12
+    ofs_table[op + '4' + pred] = 16
+
 def add_label(label, i):
     if label in regs:
         error('\'{}\' is register name'.format(label))
@@ -763,11 +879,14 @@ def eval_expr(expr):
         error('eval error: ' + expr)
 
 def calc_ofs(mnemonic, operands, addr=0):
-    if mnemonic[-1] == ':' or mnemonic in ['.global', '.set']:
+    if mnemonic[-1] == ':' or mnemonic in ['.global', '.set', '.section']:
         return 0
     if mnemonic == '.align':
         align = int(operands[0], 0)
         return ((addr + align - 1) & ~(align - 1)) - addr
+    if mnemonic == '.pgcolor':
+        page = (addr + 0xfff) & ~0xfff
+        return page + ((int(operands[0], 0) << 12) - page & 0x3000) - addr
     if mnemonic == '.byte':
         return len(operands)
     if mnemonic == '.int':
@@ -776,14 +895,29 @@ def calc_ofs(mnemonic, operands, addr=0):
         return 2 * len(operands)
     if mnemonic == '.space':
         return int(operands[0], 0)
+    if mnemonic == '.incbin':
+        return int(operands[2])
     return ofs_table.get(mnemonic, 4)
 
+# size .incbin from the file metadata; the data itself is read by code()
+def incbin_range(operands):
+    path = operands[0]
+    if not os.path.isfile(path):
+        error('file does not exist: ' + path)
+    size = os.path.getsize(path)
+    offset = int(operands[1]) if len(operands) > 1 else 0
+    length = int(operands[2]) if len(operands) > 2 else max(size - offset, 0)
+    if offset + length > size:
+        error('range exceeds file size ({:,} bytes): {}'.format(size, path))
+    incbin_files.add(path)
+    return [path, str(offset), str(length)]
+
 def init_label_first(lines):
     global labels, rev_labels, filename, pos
     labels = {}
     rev_labels = {}
     addr = entry_point
-    for mnemonic, operands, filename, pos in lines:
+    for i, (mnemonic, operands, filename, pos) in enumerate(lines):
         if mnemonic[-1] == ':':
             if len(operands) > 0:
                 error('label declaration must be followed by new line')
@@ -796,11 +930,23 @@ def init_label_first(lines):
             if imm < 4 or (imm & (imm - 1)) > 0:
                 error('alignment must be a power of 2 which is not less than 4')
             addr += ((addr + imm - 1) & ~(imm - 1)) - addr
+        elif mnemonic == '.pgcolor':
+            check_operands_n(operands, 1)
+            success, imm = parse_int(operands[0])
+            if not success or not 0 <= imm <= 3:
+                error('page color must be 0, 1, 2 or 3: ' + operands[0])
+            addr += calc_ofs(mnemonic, operands, addr)
+        elif mnemonic == '.section':
+            pass
         elif mnemonic == '.byte':
             addr += len(operands)
         elif mnemonic == '.global':
             check_operands_n(operands, 1)
             add_global(operands[0])
+        elif mnemonic == '.incbin':
+            operands = incbin_range(operands)
+            lines[i] = (mnemonic, operands, filename, pos)
+            addr += int(operands[2])
         elif mnemonic == '.int':
             addr += 4 * len(operands)
         elif mnemonic == '.set':
@@ -818,6 +964,7 @@ def init_label_first(lines):
             if addr & 3:
                 error('instruction must be aligned on 4-byte boundaries')
             addr += ofs_table.get(mnemonic, 4)
+    return addr
 
 def init_label(lines):
     global labels, rev_labels, filename, pos
@@ -833,6 +980,7 @@ def init_label(lines):
             add_label(operands[0], eval_expr(operands[1]))
         else:
             addr += calc_ofs(mnemonic, operands, addr)
+    return addr
 
 def optimize(lines):
     global filename, pos
@@ -867,16 +1015,54 @@ def optimize(lines):
             addr += calc_ofs(mnemonic, operands, addr)
     return eff > 0
 
+# Branches whose target is out of the 18-bit displacement become an inverted
+# branch over a jump through r29 (bne3 etc. if the target address fits in
+# 16 bits, bne4 etc. otherwise), and jl becomes jl2 or jl3 in the same way.
+# Forms chosen by optimize() which no longer fit are demoted. Forms only
+# grow, so this is repeated with init_label() until nothing changes.
+def relax_branches(lines):
+    global filename, pos
+    grown = False
+    addr = entry_point
+    for i, (mnemonic, operands, filename, pos) in enumerate(lines):
+        new = mnemonic
+        m = re.match(r'(bne|beq|jl)(\d?)([+-]?)$', mnemonic)
+        if m and len(operands) > 1 and not parse_int(operands[-1])[0]:
+            op, form, pred = m.groups()
+            val = label_addr(operands[-1])
+            short = 3 if op == 'jl' else 4
+            if not form and not check_int_range(val - addr - 4, 18):
+                new = op + str(short - 1 if check_int_range(val, 16) else short) + pred
+            elif form == str(short - 1) and not check_int_range(val, 16):
+                new = op + str(short) + pred
+        elif mnemonic == 'call6':
+            val = label_addr(operands[0])
+            if not check_int_range(val - addr - 16, 18):
+                new = 'call7' if check_int_range(val, 16) else 'call'
+        elif mnemonic == 'call7':
+            if not check_int_range(label_addr(operands[0]), 16):
+                new = 'call'
+        elif mnemonic in ['mov1', 'ldb1', 'stb1']:
+            if not check_int_range(eval_expr(operands[1]), 16):
+                new = mnemonic[:-1] if mnemonic == 'mov1' else mnemonic[:-1] + '2'
+        elif mnemonic in ['ld1', 'st1']:
+            if not check_int_range(eval_expr(operands[1]), 18):
+                new = mnemonic[:-1] + '2'
+        if new != mnemonic:
+            grown = True
+            lines[i] = (new, operands, filename, pos)
+        addr += calc_ofs(new, operands, addr)
+    return grown
+
 def resolve_label(lines):
     global filename, pos
-    ret = []
     addr = entry_point
     for mnemonic, operands, filename, pos in lines:
-        if mnemonic[-1] == ':' or mnemonic in ['.global', '.set']:
+        if mnemonic[-1] == ':' or mnemonic in ['.global', '.set', '.section']:
             continue
         if mnemonic == 'mov1':
             addr += 4
-            ret.append(('ldl', [operands[0], hex(eval_expr(operands[1]))], filename, pos))
+            yield ('ldl', [operands[0], hex(eval_expr(operands[1]))], filename, pos)
             continue
         if mnemonic == 'mov':
             addr += 8
@@ -886,12 +1072,12 @@ def resolve_label(lines):
                     fatal('address of start label is too large: ' + hex(val))
                 else:
                     error('expression value too large: ' + hex(val))
-            ret.append(('ldl', [operands[0], hex(val & 0xffff)], filename, pos))
-            ret.append(('ldh', [operands[0], operands[0], hex(val >> 16 & 0xffff)], filename, pos))
+            yield ('ldl', [operands[0], hex(val & 0xffff)], filename, pos)
+            yield ('ldh', [operands[0], operands[0], hex(val >> 16 & 0xffff)], filename, pos)
             continue
         if mnemonic in ['ld1', 'ldb1', 'st1', 'stb1']:
             addr += 4
-            ret.append((mnemonic[:-1], [operands[0], 'r0', hex(eval_expr(operands[1]))], filename, pos))
+            yield (mnemonic[:-1], [operands[0], 'r0', hex(eval_expr(operands[1]))], filename, pos)
             continue
         if mnemonic in ['ld2', 'ldb2', 'st2', 'stb2']:
             addr += 8
@@ -899,8 +1085,8 @@ def resolve_label(lines):
             if not -0x80000000 <= val <= 0xffffffff:
                 error('expression value too large: ' + hex(val))
             hi, lo = (val + 0x8000) >> 16 & 0xffff, ((val + 0x8000) & 0xffff) - 0x8000
-            ret.append(('ldh', ['r29', 'r0', hex(hi)], filename, pos))
-            ret.append((mnemonic[:-1], [operands[0], 'r29', hex(lo)], filename, pos))
+            yield ('ldh', ['r29', 'r0', hex(hi)], filename, pos)
+            yield (mnemonic[:-1], [operands[0], 'r29', hex(lo)], filename, pos)
             continue
         if mnemonic in ['call', 'call6', 'call7']:
             addr += ofs_table[mnemonic]
@@ -920,19 +1106,38 @@ def resolve_label(lines):
                            ('ldh', ['r29', 'r29', hex(val >> 16 & 0xffff)])]
                 mid.append(('jr', ['r28', 'r29']))
             post = [('add', ['rsp', 'rbp', 'r0', '4']), ('ld', ['rbp', 'rsp', '-4'])]
-            ret.extend(map(lambda (x, y): (x, y, filename, pos), pre + mid + post))
+            for mnemonic, operands in pre + mid + post:
+                yield (mnemonic, operands, filename, pos)
             continue
-        if mnemonic == '.align':
-            align = int(operands[0], 0)
-            padding = ((addr + align - 1) & ~(align - 1)) - addr
+        m = re.match(r'(bne|beq|jl)([234])([+-]?)$', mnemonic)
+        if m:
+            op, form, pred = m.groups()
+            addr += ofs_table[mnemonic]
+            val = label_addr(operands[-1])
+            if form == ('2' if op == 'jl' else '3'):
+                jump = [('ldl', ['r29', hex(val)])]
+            else:
+                jump = [('ldl', ['r29', hex(val & 0xffff)]),
+                        ('ldh', ['r29', 'r29', hex(val >> 16 & 0xffff)])]
+            if op == 'jl':
+                jump.append(('jr', [operands[0], 'r29']))
+            else:
+                jump.append(('jr', ['r29', 'r29']))
+                inv = ('beq' if op == 'bne' else 'bne') + ('-' if pred == '+' else '+')
+                jump.insert(0, (inv, operands[:2] + [hex(4 * len(jump))]))
+            for mnemonic, operands in jump:
+                yield (mnemonic, operands, filename, pos)
+            continue
+        if mnemonic in ['.align', '.pgcolor']:
+            padding = calc_ofs(mnemonic, operands, addr)
             if padding:
                 addr += padding
-                ret.append(('.space', [str(padding), '0'],filename, pos))
+                yield ('.space', [str(padding), '0'], filename, pos)
             continue
         if mnemonic in ['jl', 'bne', 'bne-', 'bne+', 'beq', 'beq-', 'beq+']:
             check_operands_n(operands, 2, 3)
             if not parse_int(operands[-1])[0]:
-                operands[-1] = hex(label_addr(operands[-1]) - addr - 4)
+                operands = operands[:-1] + [hex(label_addr(operands[-1]) - addr - 4)]
         if mnemonic == '.int':
             def go(operand):
                 val = eval_expr(operand)
@@ -941,10 +1146,7 @@ def resolve_label(lines):
                 return str(val) if check_int_range(val, 8) else hex(val)
             operands = map(go, operands)
         addr += calc_ofs(mnemonic, operands)
-        ret.append((mnemonic, operands, filename, pos))
-    if addr - entry_point > 0x400000:
-        fatal('program size exceeds 4MB limit ({:,} bytes)'.format(addr - entry_point))
-    return ret
+        yield (mnemonic, operands, filename, pos)
 
 def check_global(label):
     if labels[label][filename][0] < 0:
@@ -954,10 +1156,910 @@ def warn_unused_label(label):
     if not labels[label][filename][2] and not (filename in library and labels[label][filename][1]):
         warning('unused label \'{}\''.format(label))
 
-def show_label(i):
-    if i in rev_labels:
-        return format(', '.join(rev_labels[i]))
-    return ''
+def label_comments():
+    return dict((addr, ', '.join(names)) for addr, names in rev_labels.iteritems())
+
+# symbol file (-g) layout, every field is a little-endian 32-bit word:
+#   header   'GSYM', version, number of symbols, number of lines, string table size
+#   symbols  (address, name offset) sorted by address
+#   lines    (address, file name offset, line number) sorted by address,
+#            each entry covers the addresses up to the next entry
+#   strings  NUL-terminated names, referred by byte offset
+def write_symbols(f, syms, line_addrs):
+    names = sorted(set([name for addr, name in syms] + [fname for addr, fname, line in line_addrs]))
+    strtab = {}
+    ofs = 0
+    for name in names:
+        strtab[name] = ofs
+        ofs += len(name) + 1
+    strs = ''.join(name + '\0' for name in names)
+    strs += '\0' * (-len(strs) & 3)
+    f.write(struct.pack('<4sIIII', 'GSYM', 1, len(syms), len(line_addrs), len(strs)))
+    f.write(''.join(struct.pack('<II', addr, strtab[name]) for addr, name in syms))
+    f.write(''.join(struct.pack('<III', addr, strtab[fname], line) for addr, fname, line in line_addrs))
+    f.write(strs)
+
+
+# ----------------------------------------------------------------------
+#       selective linking
+# ----------------------------------------------------------------------
+
+# Library files are split into units at every .global directive (lines
+# before the first one are always kept). A unit is linked only if it is
+# reachable from the start label, the -f label or non-library code, either
+# by a label reference or by falling through from the previous unit.
+# .section lines are always kept.
+
+def label_refs(mnemonic, operands):
+    if mnemonic[-1] == ':' or mnemonic in ['.global', '.incbin', '.section']:
+        return []
+    if mnemonic == '.set':
+        operands = operands[1:]
+    refs = []
+    for operand in operands:
+        for token in re.findall(r'[\w.$!?]+', operand):
+            if token not in regs and not parse_int(token)[0]:
+                refs.append(token)
+    return refs
+
+def falls_through(mnemonic, operands):
+    if mnemonic in ['jr', 'jl']:
+        return operands[0] != 'r29'
+    if mnemonic == 'beq+':
+        return operands != ['r31', 'r31', '-4']
+    return mnemonic not in ['.byte', '.short', '.int', '.space', '.align', '.incbin']
+
+def select_library(lines, roots):
+    units = []
+    unit_of = []
+    decls = {}
+    global_decls = {}
+    heads = []
+    prev_file = None
+    for mnemonic, operands, filename, pos in lines:
+        if filename not in library:
+            unit_of.append(None)
+            roots.extend((label, filename) for label in label_refs(mnemonic, operands))
+            prev_file = None
+            continue
+        if mnemonic == '.section':
+            unit_of.append(None)
+            continue
+        if mnemonic == '.global' or filename != prev_file:
+            if mnemonic != '.global':
+                heads.append(len(units))
+            # [file, referenced labels, reached, falls through to next unit]
+            units.append([filename, [], False, False])
+            prev_file = filename
+        unit = len(units) - 1
+        unit_of.append(unit)
+        if mnemonic[-1] == ':':
+            decls[mnemonic[:-1], filename] = unit
+        elif mnemonic == '.set':
+            decls[operands[0], filename] = unit
+        elif mnemonic == '.global':
+            global_decls.setdefault(operands[0], []).append(filename)
+        else:
+            units[unit][1].extend(label_refs(mnemonic, operands))
+            units[unit][3] = falls_through(mnemonic, operands)
+
+    def reach(unit):
+        while not units[unit][2]:
+            units[unit][2] = True
+            roots.extend((label, units[unit][0]) for label in units[unit][1])
+            if not units[unit][3] or unit + 1 == len(units) or units[unit + 1][0] != units[unit][0]:
+                break
+            unit += 1
+
+    for unit in heads:
+        reach(unit)
+    while roots:
+        label, filename = roots.pop()
+        if (label, filename) in decls:
+            reach(decls[label, filename])
+        else:
+            for f in global_decls.get(label, []):
+                if (label, f) in decls:
+                    reach(decls[label, f])
+    return [line for line, unit in zip(lines, unit_of) if unit is None or units[unit][2]]
+
+
+# ----------------------------------------------------------------------
+#       data pooling
+# ----------------------------------------------------------------------
+
+# A .rodata line starts a run of labelled read-only data blocks, which ends
+# at the first line that is neither a label nor .byte, .short, .int, .space
+# or .align. With --pool-data, every block is moved to a pool at the end of
+# the program (before the -f label), blocks with the same contents are
+# merged, and byte blocks which end another byte block point into it. The
+# labels keep their file, so local labels stay local.
+
+rodata_mnemonics = ['.byte', '.short', '.int', '.space']
+pool_stats = {'merged': 0, 'saved': 0}
+
+def rodata_bytes(data):
+    global filename, pos
+    for mnemonic, operands, filename, pos in data:
+        if not all(parse_int(operand)[0] for operand in operands):
+            return None
+    return ''.join(code(mnemonic, operands) for mnemonic, operands, filename, pos in data)
+
+def rodata_blocks(lines):
+    global filename, pos
+    rest = []
+    blocks = []
+    block = None
+    head = []
+    rodata_file = None
+    for line in lines:
+        mnemonic, operands, filename, pos = line
+        if mnemonic == '.rodata':
+            check_operands_n(operands, 0)
+            rodata_file = filename
+        elif filename != rodata_file or not (mnemonic[-1] == ':' or mnemonic in ['.align', '.global', '.set'] + rodata_mnemonics):
+            # labels followed by code are not part of the data
+            rodata_file = None
+        elif mnemonic in ['.global', '.set']:
+            rest.append(line)
+            continue
+        elif mnemonic[-1] == ':' or mnemonic == '.align':
+            head.append(line)
+            if mnemonic[-1] == ':':
+                block = None
+            continue
+        elif mnemonic in rodata_mnemonics:
+            if block and head:
+                # only a label starts a new block; .align between data stays
+                block['data'].extend(head)
+                head = []
+            elif head:
+                # leading labels and .align lines in source order, and data lines
+                block = {'head': head, 'data': []}
+                blocks.append(block)
+                head = []
+            if not block:
+                error('data in .rodata must follow a label')
+            block['data'].append(line)
+            continue
+        rest.extend(head)
+        head = []
+        block = None
+        if mnemonic != '.rodata':
+            rest.append(line)
+    rest.extend(head)
+    return rest, blocks
+
+def pool_rodata(lines):
+    global pool_stats
+    pool_stats = {'merged': 0, 'saved': 0}
+    rest, blocks = rodata_blocks(lines)
+    pool = []
+    unique = {}
+    for block in blocks:
+        # a block with .align inside keeps its own layout and is not merged
+        aligns = [int(line[1][0], 0) for line in block['data'] if line[0] == '.align']
+        block['bytes'] = None if aligns else rodata_bytes(block['data'])
+        block['words'] = bool(aligns) or any(line[0] in ['.short', '.int'] for line in block['data'])
+        block['align'] = max([4] + aligns)
+        key = block['bytes'], block['words']
+        if block['bytes'] is not None and key in unique:
+            # the strictest .align goes before all labels, so that none of
+            # them points at the padding
+            head = unique[key]['head'] + block['head']
+            aligns = sorted((line for line in head if line[0] == '.align'), key=lambda line: -int(line[1][0], 0))
+            unique[key]['head'] = aligns[:1] + [line for line in head if line[0] != '.align']
+            pool_stats['merged'] += 1
+            pool_stats['saved'] += len(block['bytes'])
+            continue
+        if block['bytes'] is not None:
+            unique[key] = block
+        pool.append(block)
+
+    # a byte block which ends another one is a prefix of the next block in
+    # the order of reversed contents
+    tails = sorted((block for block in pool if block['bytes'] and not block['words']),
+                   key=lambda block: block['bytes'][::-1])
+    host = None
+    for block in reversed(tails):
+        if host and host['bytes'].endswith(block['bytes']) and \
+           not any(line[0] == '.align' for line in block['head']):
+            host.setdefault('guests', []).append((len(host['bytes']) - len(block['bytes']), block))
+            block['merged'] = True
+            pool_stats['merged'] += 1
+            pool_stats['saved'] += len(block['bytes'])
+        else:
+            host = block
+
+    out = []
+    for block in sorted(pool, key=lambda block: not block['words']):
+        if block.get('merged'):
+            continue
+        f, p = block['data'][0][2:]
+        if block['words']:
+            out.append(('.align', [str(block['align'])], f, p))
+        out.extend(block['head'])
+        if 'guests' not in block:
+            out.extend(block['data'])
+            continue
+        data = block['bytes']
+        ofs = 0
+        for start, guest in sorted(block['guests'], key=lambda (start, guest): start):
+            out.append(('.byte', [str(ord(c)) for c in data[ofs:start]], f, p))
+            out.extend(guest['head'])
+            ofs = start
+        out.append(('.byte', [str(ord(c)) for c in data[ofs:]], f, p))
+    if out:
+        out.append(('.align', ['4'], f, p))
+    i = next((i for i, line in enumerate(rest) if line[2] == '_end' or line[:2] == ('.section', ['bss'])), len(rest))
+    return rest[:i] + out + rest[i:]
+
+
+# ----------------------------------------------------------------------
+#       sections
+# ----------------------------------------------------------------------
+
+# Every file starts in the text section. The sections are laid out in the
+# order text, data, bss, each keeping the source order of its lines, and
+# the -f label comes last. A .section line is left at the start of data and
+# bss; the bss section is not written to the output, so it is not cleared
+# on load. A section given a page color (.section data, 1) starts at the
+# next page of that color; with --page-color, sections without one start
+# at the next page, whose color differs from the last page of the section
+# before it.
+
+section_names = ['text', 'data', 'bss']
+
+def layout_sections(lines, page_color):
+    global filename, pos
+    groups = dict((name, []) for name in section_names)
+    colors = {}
+    end = []
+    section = None
+    prev_file = None
+    for line in lines:
+        mnemonic, operands, filename, pos = line
+        if filename == '_end':
+            end.append(line)
+            continue
+        if filename != prev_file:
+            section = 'text'
+            prev_file = filename
+        if mnemonic == '.section':
+            check_operands_n(operands, 1, 2)
+            section = operands[0]
+            if section not in groups:
+                error('unknown section: ' + section)
+            if len(operands) > 1:
+                success, color = parse_int(operands[1])
+                if not success or not 0 <= color <= 3:
+                    error('page color must be 0, 1, 2 or 3: ' + operands[1])
+                if colors.setdefault(section, (color, filename, pos))[0] != color:
+                    error('conflicting page color for section ' + section)
+            continue
+        if section == 'bss':
+            if not (mnemonic[-1] == ':' or mnemonic in ['.space', '.align', '.global', '.set']):
+                error('only labels, .space and .align are allowed in bss section')
+            if mnemonic == '.space' and parse_int(operands[1])[1] != 0:
+                error('bss section cannot be filled with non-zero value')
+        groups[section].append(line)
+
+    ret = groups['text']
+    if 'text' in colors:
+        i = next((i for i, line in enumerate(ret) if line[2]), len(ret))
+        ret.insert(i, ('.pgcolor', [str(colors['text'][0])]) + colors['text'][1:])
+    for name in ['data', 'bss']:
+        if not groups[name]:
+            continue
+        f, p = groups[name][0][2:]
+        ret.append(('.section', [name], f, p))
+        if name in colors:
+            ret.append(('.pgcolor', [str(colors[name][0])]) + colors[name][1:])
+        else:
+            ret.append(('.align', ['4096' if page_color else '4'], f, p))
+        ret.extend(groups[name])
+    if end and (groups['data'] or groups['bss']):
+        ret.append(('.align', ['4']) + ret[-1][2:])
+    return ret + end
+
+
+# ----------------------------------------------------------------------
+#       code placement
+# ----------------------------------------------------------------------
+
+# With --function-order refs, the text section is split into functions as
+# in selective linking and the most referenced ones are moved to the lowest
+# addresses, where more calls and label loads fit the short forms. A
+# function falling through (or aligned) into the next one stays in front of
+# it, and the first one (the startup jump, or the entry point with -r)
+# stays first. --align-loops n pads every loop head, i.e. a label branched
+# to from below in the same file, to a multiple of n bytes.
+
+def text_end(lines):
+    return next((i for i, line in enumerate(lines) if line[0] == '.section' or line[2] == '_end'), len(lines))
+
+def order_functions(lines):
+    end = text_end(lines)
+    chains = []
+    decls = {}
+    glued = False
+    prev_file = None
+    for line in lines[:end]:
+        mnemonic, operands, filename = line[:3]
+        if not chains or filename != prev_file or mnemonic == '.global' and not glued:
+            chains.append([])
+            glued = True
+            prev_file = filename
+        chains[-1].append(line)
+        if mnemonic[-1] == ':':
+            decls.setdefault(mnemonic[:-1], []).append((filename, len(chains) - 1))
+        elif mnemonic == '.set':
+            decls.setdefault(operands[0], []).append((filename, len(chains) - 1))
+        elif mnemonic != '.global':
+            glued = mnemonic in ['.align', '.pgcolor'] or falls_through(mnemonic, operands)
+    if len(chains) < 3:
+        return lines
+
+    refs = [0] * len(chains)
+    for mnemonic, operands, filename, pos in lines:
+        for label in label_refs(mnemonic, operands):
+            places = decls.get(label, [])
+            for f, chain in [place for place in places if place[0] == filename][:1] or places[:1]:
+                refs[chain] += 1
+    ret = list(chains[0])
+    for chain in sorted(range(1, len(chains)), key=lambda chain: -refs[chain]):
+        ret.extend(chains[chain])
+    # the .align appended to the last file may have moved
+    ret.append(('.align', ['4']) + lines[end - 1][2:])
+    return ret + lines[end:]
+
+def align_loops(lines, align):
+    end = text_end(lines)
+    seen = {}
+    heads = set()
+    for i, (mnemonic, operands, filename, pos) in enumerate(lines[:end]):
+        if mnemonic[-1] == ':':
+            seen[mnemonic[:-1], filename] = i
+        elif re.match(r'(bne|beq|jl)[+-]?$', mnemonic) and len(operands) > 1 and (operands[-1], filename) in seen:
+            head = seen[operands[-1], filename]
+            while head > 0 and lines[head - 1][0][-1] == ':' and lines[head - 1][2] == filename:
+                head -= 1
+            heads.add(head)
+    ret = []
+    for i, line in enumerate(lines):
+        if i in heads:
+            ret.append(('.align', [str(align)]) + line[2:])
+        ret.append(line)
+    return ret
+
+
+# ----------------------------------------------------------------------
+#       cost report
+# ----------------------------------------------------------------------
+
+# Functions are the start label, the targets of call and "jl r28", and
+# global labels; every line belongs to the last function label before it.
+# A call costs 4 bytes of stack (rbp) and "enter N" in the callee N + 4.
+
+data_mnemonics = ['.byte', '.short', '.int', '.space', '.align', '.pgcolor', '.incbin']
+call_mnemonics = ['call', 'call6', 'call7']
+
+def source_macro(filename, pos):
+    if not filename:
+        return '(startup)'
+    mnemonic, operands = parse(srcs[filename][pos])
+    return mnemonic or '(none)'
+
+def r29_loads(mnemonic, operands):
+    if mnemonic in ['mov', 'mov1'] and operands[0] == 'r29':
+        return 2 if mnemonic == 'mov' else 1
+    if mnemonic in ['ld2', 'st2', 'ldb2', 'stb2', 'call7', 'jl2', 'bne3', 'beq3'] or \
+       re.match(r'(bne|beq)3[+-]$', mnemonic):
+        return 1
+    if mnemonic in ['call', 'jl3', 'bne4', 'beq4'] or re.match(r'(bne|beq)4[+-]$', mnemonic):
+        return 2
+    return 0
+
+def call_target(mnemonic, operands):
+    if mnemonic in call_mnemonics:
+        return operands[0]
+    if re.match(r'jl\d?$', mnemonic) and operands[0] == 'r28' and not parse_int(operands[1])[0]:
+        return operands[1]
+    return None
+
+# Estimated number of executed instructions, used by --autotune: every
+# instruction counts loop_weight times for each loop (a backward branch in
+# the same file) around it. Data and alignment padding cost nothing.
+loop_weight = 8
+
+def static_cost(lines):
+    global filename, pos
+    seen = {}
+    nest = [0] * (len(lines) + 1)
+    for i, (mnemonic, operands, filename, pos) in enumerate(lines):
+        if mnemonic[-1] == ':':
+            seen[mnemonic[:-1], filename] = i
+        elif re.match(r'(bne|beq|jl)\d?[+-]?$', mnemonic) and operands[0] != 'r28' and (operands[-1], filename) in seen:
+            nest[seen[operands[-1], filename]] += 1
+            nest[i + 1] -= 1
+    cost = depth = 0
+    addr = entry_point
+    for i, (mnemonic, operands, filename, pos) in enumerate(lines):
+        depth += nest[i]
+        size = calc_ofs(mnemonic, operands, addr)
+        addr += size
+        if mnemonic[-1] != ':' and mnemonic not in data_mnemonics:
+            cost += size / 4 * loop_weight ** depth
+    return cost
+
+def write_cost_report(f, lines, roots):
+    global filename, pos
+    funcs = set(map(label_addr, roots))
+    for mnemonic, operands, filename, pos in lines:
+        target = call_target(mnemonic, operands)
+        if target:
+            funcs.add(label_addr(target))
+        elif mnemonic == '.global' and labels[operands[0]][filename][0] >= 0:
+            funcs.add(labels[operands[0]][filename][0])
+
+    # [instructions, bytes, call sites, frame size, callee addresses, entry address]
+    stats = {}
+    order = []
+    forms = dict((form, 0) for form in call_mnemonics + ['call (register)'])
+    macros = {}
+    overhead = {'call': 0, 'r29': 0, 'io': 0}
+    func = '(startup)' if lines and not lines[0][2] else '(none)'
+    seen = set()
+    addr = entry_point
+    total = 0
+    for mnemonic, operands, filename, pos in lines:
+        if mnemonic[-1] == ':' and addr in funcs and stats.get(func, [0] * 6)[5] != addr:
+            func = mnemonic[:-1]
+            if func in stats:
+                func = '{} ({})'.format(func, filename)
+        if func not in stats:
+            stats[func] = [0, 0, 0, 0, [], addr]
+            order.append(func)
+        st = stats[func]
+        size = calc_ofs(mnemonic, operands, addr)
+        addr += size
+        st[1] += size
+        if mnemonic[-1] == ':' or mnemonic in data_mnemonics or not size:
+            continue
+        n = size / 4
+        st[0] += n
+        total += n
+        macro = source_macro(filename, pos)
+        first = (filename, pos) not in seen
+        seen.add((filename, pos))
+        m = macros.setdefault(macro, [0, 0])
+        m[0] += first
+        m[1] += n
+        target = call_target(mnemonic, operands)
+        if target:
+            st[2] += 1
+            st[4].append(label_addr(target))
+        if mnemonic in call_mnemonics:
+            forms[mnemonic] += 1
+        elif macro == 'call' and mnemonic == 'jr':
+            forms['call (register)'] += 1
+        if macro == 'call':
+            overhead['call'] += n
+        elif macro in ['read', 'write']:
+            overhead['io'] += n
+        else:
+            overhead['r29'] += r29_loads(mnemonic, operands)
+        if macro == 'enter' and first:
+            operands = parse(srcs[filename][pos])[1]
+            st[3] = max(st[3], (parse_int(operands[0])[1] if operands else 0) + 4)
+
+    # call graph over function entry addresses
+    name_of = dict((st[5], name) for name, st in stats.iteritems())
+    depth = {}
+    recursive = []
+    def visit(name, path):
+        if name in depth:
+            return depth[name]
+        if name in path:
+            recursive.append(path[path.index(name):] + [name])
+            return None
+        best = (0, 0, [])
+        for callee in sorted(set(name_of.get(a, '(none)') for a in stats[name][4])):
+            d = visit(callee, path + [name]) if callee in stats else None
+            if d:
+                best = max(best, (d[0] + 4, d[1] + 1, d[2]))
+        depth[name] = (best[0] + stats[name][3], best[1], [name] + best[2])
+        return depth[name]
+    for name in order:
+        visit(name, [])
+
+    pct = lambda n: 100.0 * n / max(total, 1)
+    f.write('# functions\n')
+    f.write('{:>10} {:>10} {:>6} {:>6} {:>6}  {}\n'.format('instrs', 'bytes', 'calls', 'frame', 'stack', 'function'))
+    for name in order:
+        st = stats[name]
+        if not st[0]:
+            continue
+        f.write('{:>10,} {:>10,} {:>6,} {:>6,} {:>6,}  {}\n'.format(st[0], st[1], st[2], st[3], depth[name][0], name))
+    f.write('\n# call forms\n')
+    ncalls = max(sum(forms.values()), 1)
+    for form in call_mnemonics + ['call (register)']:
+        f.write('{:>10,} {:6.2f}%  {}\n'.format(forms[form], 100.0 * forms[form] / ncalls, form))
+    f.write('\n# instructions added by macros (of {:,})\n'.format(total))
+    f.write('{:>10,} {:6.2f}%  call sequences\n'.format(overhead['call'], pct(overhead['call'])))
+    f.write('{:>10,} {:6.2f}%  r29 constant loads\n'.format(overhead['r29'], pct(overhead['r29'])))
+    f.write('{:>10,} {:6.2f}%  read/write polling\n'.format(overhead['io'], pct(overhead['io'])))
+    f.write('\n# source macros\n')
+    f.write('{:>10} {:>10} {:>8}  {}\n'.format('lines', 'instrs', 'average', 'macro'))
+    for macro, (n, m) in sorted(macros.iteritems(), key=lambda (k, v): (-v[1], k)):
+        f.write('{:>10,} {:>10,} {:>8.2f}  {}\n'.format(n, m, 1.0 * m / max(n, 1), macro))
+    f.write('\n# call graph\n')
+    for name in order:
+        callees = sorted(set(name_of.get(a, '?') for a in stats[name][4]))
+        if callees:
+            f.write('{} -> {}\n'.format(name, ', '.join(callees)))
+    root = max(order, key=lambda name: (depth[name][1], depth[name][0])) if order else None
+    if root:
+        f.write('\n# longest call chain: {} (depth {})\n'.format(' -> '.join(depth[root][2]), depth[root][1]))
+    for start in [name_of.get(label_addr(label)) for label in roots]:
+        if start:
+            f.write('# worst-case stack depth from {}: {:,} bytes\n'.format(start, depth[start][0]))
+    for cycle in recursive:
+        f.write('# recursion (not counted): {}\n'.format(' -> '.join(cycle)))
+
+
+# ----------------------------------------------------------------------
+#       serial upload
+# ----------------------------------------------------------------------
+
+# The image is sent in the format bootloader.s expects: 4-byte size header
+# followed by the program. Chunks are written by a separate thread, so the
+# transfer starts while the rest of the program is still being encoded.
+
+def open_serial(path, baud):
+    if termios is None:
+        fatal('--send is not supported on this platform')
+    baud_rates = dict((int(name[1:]), getattr(termios, name)) for name in dir(termios) if re.match(r'B\d+$', name))
+    if baud not in baud_rates:
+        fatal('unsupported baud rate: {}'.format(baud))
+    try:
+        fd = os.open(path, os.O_RDWR | os.O_NOCTTY)
+        attr = termios.tcgetattr(fd)
+        attr[0] = 0                                                         # iflag
+        attr[1] = 0                                                         # oflag
+        attr[2] = termios.CS8 | termios.CREAD | termios.CLOCAL              # cflag
+        attr[3] = 0                                                         # lflag
+        attr[4] = attr[5] = baud_rates[baud]
+        attr[6][termios.VMIN] = 1
+        attr[6][termios.VTIME] = 0
+        termios.tcsetattr(fd, termios.TCSANOW, attr)
+        termios.tcflush(fd, termios.TCIOFLUSH)
+    except (OSError, termios.error) as e:
+        fatal('cannot open serial port {}: {}'.format(path, e.args[-1]))
+    return fd
+
+def send_loop(fd, queue, state):
+    try:
+        while True:
+            data = queue.get()
+            if data is None:
+                break
+            ofs = 0
+            while ofs < len(data):
+                ofs += os.write(fd, buffer(data, ofs))
+            state['sent'] += len(data)
+        termios.tcdrain(fd)
+    except (OSError, termios.error) as e:
+        state['error'] = e.args[-1]
+        while queue.get() is not None:
+            pass
+
+def start_send(args, size):
+    fd = open_serial(args.send, args.baud)
+    queue = Queue.Queue(64)
+    state = {'fd': fd, 'queue': queue, 'sent': 0, 'error': None, 'start': time.time(), 'buf': [], 'buffered': 0}
+    state['thread'] = threading.Thread(target=send_loop, args=(fd, queue, state))
+    state['thread'].daemon = True
+    state['thread'].start()
+    send(state, ''.join(chr(size >> x & 255) for x in [0, 8, 16, 24]))
+    return state
+
+def send(state, data, chunk_size=1 << 14):
+    state['buf'].append(data)
+    state['buffered'] += len(data)
+    if state['buffered'] >= chunk_size:
+        state['queue'].put(''.join(state['buf']))
+        state['buf'] = []
+        state['buffered'] = 0
+
+def finish_send(state):
+    state['queue'].put(''.join(state['buf']))
+    state['queue'].put(None)
+    state['thread'].join()
+    os.close(state['fd'])
+    if state['error']:
+        fatal('serial write failed: {}'.format(state['error']))
+    elapsed = max(time.time() - state['start'], 1e-6)
+    print >> sys.stderr, '{}: sent {:,} bytes in {:.2f} s ({:.1f} KB/s)'.format(
+        os.path.basename(sys.argv[0]), state['sent'], elapsed, state['sent'] / elapsed / 1024)
+
+
+# ----------------------------------------------------------------------
+#       program compression
+# ----------------------------------------------------------------------
+
+# The packed image is a stream of 32-bit tokens, decoded by unpack_source:
+#   00 | count                    count literal words follow
+#   01 | count                    one word follows, repeated count times
+#   10 | count(14) | distance(16) copy count words from distance words back
+#   11                            end of stream
+
+memory_size = 0x400000
+
+def compress_words(words):
+    out = []
+    lits = []
+    heads = {}
+    n = len(words)
+    i = 0
+    while i < n:
+        w = words[i]
+        run = 1
+        while i + run < n and words[i + run] == w and run < 0x3fffffff:
+            run += 1
+        best = dist = 0
+        if i + 1 < n:
+            for j in reversed(heads.get((w, words[i + 1]), [])[-16:]):
+                if i - j > 0xffff:
+                    break
+                l = 2
+                while i + l < n and l < 0x3fff and words[j + l] == words[i + l]:
+                    l += 1
+                if l > best:
+                    best, dist = l, i - j
+        if run >= 3 and run >= best:
+            step, indexed = run, 1  # long runs are only indexed at their start
+            token = [1 << 30 | run, w]
+        elif best >= 2:
+            step = indexed = best
+            token = [2 << 30 | best << 16 | dist]
+        else:
+            step = indexed = 1
+            token = None
+            lits.append(w)
+        if token:
+            if lits:
+                out.append(len(lits))
+                out.extend(lits)
+                lits = []
+            out.extend(token)
+        for k in xrange(i, min(i + indexed, n - 1)):
+            heads.setdefault((words[k], words[k + 1]), []).append(k)
+        i += step
+    if lits:
+        out.append(len(lits))
+        out.extend(lits)
+    out.append(3 << 30)
+    return out
+
+def decompress_words(tokens):
+    out = []
+    i = 0
+    while tokens[i] >> 30 != 3:
+        kind, count = tokens[i] >> 30, tokens[i] & 0x3fffffff
+        if kind == 0:
+            out.extend(tokens[i + 1 : i + 1 + count])
+            i += 1 + count
+        elif kind == 1:
+            out.extend([tokens[i + 1]] * count)
+            i += 2
+        else:
+            start = len(out) - (count & 0xffff)
+            for k in xrange(count >> 16):
+                out.append(out[start + k])
+            i += 1
+    return out
+
+unpack_source = """
+unpack_start:
+    jl      r1, 0
+    sub     r1, r1, 4
+    mov     r2, RELOC
+    mov     r3, BLOB_SIZE
+unpack_copy:
+    sub     r3, r3, 4
+    add     r4, r1, r3
+    mov     r5, [r4]
+    add     r4, r2, r3
+    mov     [r4], r5
+    bnz     r3, unpack_copy
+    mov     r29, RELOC + unpack_main - unpack_start
+    jr      r29
+unpack_main:
+    mov     r1, RELOC + unpack_data - unpack_start
+    mov     r2, DEST
+unpack_loop:
+    mov     r3, [r1]
+    add     r1, r1, 4
+    shr     r4, r3, 30
+    shl     r3, r3, 2
+    shr     r3, r3, 2
+    bz      r4, unpack_literal
+    sub     r4, r4, 1
+    bz      r4, unpack_fill
+    sub     r4, r4, 1
+    bz      r4, unpack_match
+    mov     r1, 0
+    mov     r2, 0
+    mov     r3, 0
+    mov     r4, 0
+    mov     r5, 0
+    mov     r6, 0
+    mov     r29, DEST
+    jr      r29
+unpack_literal:
+    mov     r5, [r1]
+    add     r1, r1, 4
+    mov     [r2], r5
+    add     r2, r2, 4
+    sub     r3, r3, 1
+    bnz     r3, unpack_literal
+    br      unpack_loop
+unpack_fill:
+    mov     r5, [r1]
+    add     r1, r1, 4
+unpack_fill_loop:
+    mov     [r2], r5
+    add     r2, r2, 4
+    sub     r3, r3, 1
+    bnz     r3, unpack_fill_loop
+    br      unpack_loop
+unpack_match:
+    shl     r6, r3, 16
+    shr     r6, r6, 14
+    shr     r3, r3, 16
+    sub     r6, r2, r6
+unpack_match_loop:
+    mov     r5, [r6]
+    add     r6, r6, 4
+    mov     [r2], r5
+    add     r2, r2, 4
+    sub     r3, r3, 1
+    bnz     r3, unpack_match_loop
+    br      unpack_loop
+unpack_data:
+.set    BLOB_SIZE, unpack_data - unpack_start + {packed_size}
+.set    RELOC, ({memory_size} - BLOB_SIZE) & ~0xfff
+.set    DEST, {dest}
+"""
+
+def assemble_stub(name, source):
+    global filename, pos, entry_point
+    saved_entry_point = entry_point
+    entry_point = 0x2000  # load address of bootloader.s
+    lines0 = [(line.strip(), name, i + 1) for i, line in enumerate(source.splitlines()) if line.strip()]
+    srcs[name] = dict((pos, line) for line, filename, pos in lines0)
+    lines1 = expand_lines(lines0)
+    init_label_first(lines1)
+    stub = []
+    for mnemonic, operands, filename, pos in resolve_label(lines1):
+        stub.append(code(mnemonic, operands))
+    entry_point = saved_entry_point
+    return ''.join(stub), labels['RELOC'][name][0]
+
+def pack(image):
+    image += '\0' * (-len(image) & 3)
+    words = list(struct.unpack('<{}I'.format(len(image) / 4), image))
+    tokens = compress_words(words)
+    if decompress_words(tokens) != words:
+        fatal('internal error: compression failed')
+    data = struct.pack('<{}I'.format(len(tokens)), *tokens)
+    source = unpack_source.format(packed_size=len(data), memory_size=memory_size, dest=entry_point)
+    stub, reloc = assemble_stub('<unpack>', source)
+    if entry_point + len(image) > reloc:
+        fatal('packed program does not fit in {}MB memory'.format(memory_size >> 20))
+    return stub + data
+
+
+# ----------------------------------------------------------------------
+#       build cache
+# ----------------------------------------------------------------------
+
+# A cache entry is a directory named by the hash of everything that affects
+# the outputs. Entries are built in a temporary directory and renamed into
+# place, so concurrent processes sharing the cache never see partial ones.
+
+def cache_key(args):
+    h = hashlib.sha1()
+    with open(__file__, 'rb') as f:
+        h.update(f.read())
+    opts = [args.e, args.t, args.f, args.O, args.r, args.c, args.k, args.a,
+            args.s, args.v, args.g, args.z, args.rom_depth, args.rom_format,
+            args.Wno_unused_label, args.Wr29, args.gc_library, args.pool_data, args.page_color, args.cost_report,
+            args.function_order, args.align_loops, library]
+    h.update(json.dumps(opts))
+    for name in args.inputs:
+        name = os.path.relpath(name)
+        if not os.path.isfile(name):
+            return None
+        with open(name, 'rb') as f:
+            h.update('\0{}\0{}\0'.format(name, os.path.getsize(name)))
+            h.update(f.read())
+    return h.hexdigest()
+
+# files included by .incbin are only known after assembly, so their digests
+# are kept in the manifest and checked on every hit
+def file_digest(path):
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except IOError:
+        return None
+
+def cache_fetch(args, key):
+    global filename, pos
+    entry = os.path.join(args.cache_dir, key)
+    try:
+        with open(os.path.join(entry, 'manifest'), 'r') as f:
+            manifest = json.load(f)
+        for path, digest in manifest['incbin'].iteritems():
+            if file_digest(path) != digest:
+                return False
+        for i, suffix in enumerate(manifest['outputs']):
+            shutil.copyfile(os.path.join(entry, 'out{}'.format(i)), args.o + suffix)
+        os.utime(entry, None)
+    except (IOError, OSError, ValueError, KeyError):
+        return False
+    for filename, pos, msg, line in manifest['warnings']:
+        srcs.setdefault(filename, {})[pos] = line
+        warning(msg, line is not None)
+    return True
+
+def cache_store(args, key):
+    try:
+        tmp = tempfile.mkdtemp(prefix='.tmp', dir=args.cache_dir)
+    except OSError:
+        return
+    try:
+        for i, suffix in enumerate(output_suffixes):
+            shutil.copyfile(args.o + suffix, os.path.join(tmp, 'out{}'.format(i)))
+        with open(os.path.join(tmp, 'manifest'), 'w') as f:
+            incbin = dict((path, file_digest(path)) for path in incbin_files)
+            json.dump({'outputs': output_suffixes, 'warnings': warning_log, 'incbin': incbin}, f)
+        entry = os.path.join(args.cache_dir, key)
+        if os.path.isdir(entry):
+            # stale entry whose .incbin files have changed
+            os.rename(entry, os.path.join(tmp, 'old'))
+            shutil.rmtree(os.path.join(tmp, 'old'), True)
+        os.rename(tmp, entry)
+    except (IOError, OSError):
+        shutil.rmtree(tmp, True)
+        return
+    cache_evict(args)
+
+def cache_evict(args):
+    entries = []
+    total = 0
+    for key in os.listdir(args.cache_dir):
+        entry = os.path.join(args.cache_dir, key)
+        if key.startswith('.tmp'):
+            continue
+        try:
+            size = sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+            entries.append((os.path.getmtime(entry), size, entry))
+        except OSError:
+            continue
+        total += size
+    for mtime, size, entry in sorted(entries):
+        if total <= args.cache_size << 20:
+            break
+        try:
+            tmp = tempfile.mkdtemp(prefix='.tmp', dir=args.cache_dir)
+            os.rename(entry, os.path.join(tmp, 'old'))
+            shutil.rmtree(tmp, True)
+        except OSError:
+            continue
+        total -= size
 
 
 # ----------------------------------------------------------------------
@@ -971,6 +2073,8 @@ argparser.add_argument('-a', help='output as rs232c send test format', action='s
 argparser.add_argument('-c', help='do not append file header', action='store_true')
 argparser.add_argument('-e', help='set entry point address', metavar='<integer>')
 argparser.add_argument('-f', help='append label to end of program', metavar='<label>')
+argparser.add_argument('-g', help='output symbol and line table', action='store_true')
+argparser.add_argument('-j', help='run <integer> batch jobs or autotune candidates in parallel', metavar='<integer>', type=int)
 argparser.add_argument('-k', help='output as array of std_logic_vector format', action='store_true')
 argparser.add_argument('-l', help='set library file to <file>', metavar='<file>', action='append')
 argparser.add_argument('-o', help='set output file to <file>', metavar='<file>', default='a.out')
@@ -980,35 +2084,72 @@ argparser.add_argument('-s', help='output preprocessed assembly', action='store_
 argparser.add_argument('-start', help='same as -t (deprecated)', metavar='<label>', dest='t')
 argparser.add_argument('-t', help='start execution from <label>', metavar='<label>')
 argparser.add_argument('-v', help='output more detailed assembly than -s', action='store_true')
+argparser.add_argument('-z', help='compress program and prepend a self-decompressing loader', action='store_true')
 argparser.add_argument('-Wno-unused-label', help='disable unused label warning', action='store_true')
 argparser.add_argument('-Wr29', help='enable use of r29 warning', action='store_true')
-args = argparser.parse_args()
-if args.inputs == []:
-    argparser.print_help(sys.stderr)
-    sys.exit(1)
-if args.e:
-    success, entry_point = parse_int(args.e)
-    if not success:
-        argparser.print_usage(sys.stderr)
-        fatal('argument -e: expected integer: ' + args.e)
-    if entry_point & 3 != 0:
+argparser.add_argument('--align-loops', help='align loop heads to <integer> bytes', metavar='<integer>', default=0, type=int)
+argparser.add_argument('--autotune', help='choose the options giving the best program and record them in <file>.tune', action='store_true')
+argparser.add_argument('--baud', help='set baud rate of --send (default: 115200)', metavar='<integer>', default=115200, type=int)
+argparser.add_argument('--batch', help='assemble every job listed in <file>', metavar='<file>')
+argparser.add_argument('--cache-dir', help='reuse outputs cached in <dir>', metavar='<dir>')
+argparser.add_argument('--cost-report', help='output static cost of each function to <file>.cost', action='store_true')
+argparser.add_argument('--function-order', help='set order of functions (default: source)', choices=['source', 'refs'], default='source')
+argparser.add_argument('--gc-library', help='link only library functions reachable from the program', action='store_true')
+argparser.add_argument('--page-color', help='start data and bss sections on a new page', action='store_true')
+argparser.add_argument('--pool-data', help='merge identical .rodata blocks into a pool at the end of program', action='store_true')
+argparser.add_argument('--rom-depth', help='split -k output into banks of <integer> words', metavar='<integer>', type=int)
+argparser.add_argument('--rom-format', help='set -k output format (default: vhdl)', choices=['vhdl', 'coe', 'mif'], default='vhdl')
+argparser.add_argument('--cache-size', help='limit cache size to <integer> MB (default: 512)', metavar='<integer>', default=512, type=int)
+argparser.add_argument('--send', help='upload the program to the bootloader on serial port <tty>', metavar='<tty>')
+argparser.add_argument('--tune-config', help='use the options recorded in <file> by --autotune', metavar='<file>')
+argparser.add_argument('--tune-input', help='feed <file> to the program on --tune-sim runs', metavar='<file>')
+argparser.add_argument('--tune-sim', help='score --autotune candidates by running <command> (e.g. "./sim -simple")', metavar='<command>')
+
+def setup(args):
+    global entry_point, start_label, library
+    entry_point = 0x2000
+    start_label = 'main'
+    library = []
+    if args.inputs == []:
+        argparser.print_help(sys.stderr)
+        sys.exit(1)
+    if args.e:
+        success, entry_point = parse_int(args.e)
+        if not success:
+            argparser.print_usage(sys.stderr)
+            fatal('argument -e: expected integer: ' + args.e)
+        if entry_point & 3 != 0:
+            argparser.print_usage(sys.stderr)
+            fatal('argument -e: entry address must be a multiple of 4')
+        if entry_point < 0:
+            argparser.print_usage(sys.stderr)
+            fatal('argument -e: entry address must be zero or positive')
+    if args.l:
+        library = map(os.path.relpath, args.l)
+        args.inputs = library + args.inputs
+    if args.t:
+        start_label = args.t
+    if args.tune_config:
+        apply_tune_config(args, args.tune_config)
+    if args.align_loops < 0 or args.align_loops & (args.align_loops - 1) or 0 < args.align_loops < 4:
         argparser.print_usage(sys.stderr)
-        fatal('argument -e: entry address must be a multiple of 4')
-    if entry_point < 0:
+        fatal('argument --align-loops: alignment must be a power of 2 (at least 4)')
+    if args.rom_depth is not None and args.rom_depth <= 0:
         argparser.print_usage(sys.stderr)
-        fatal('argument -e: entry address must be zero or positive')
-if args.l:
-    library = map(os.path.relpath, args.l)
-    args.inputs = library + args.inputs
-if args.t:
-    start_label = args.t
-
-# 0. preprocess
-lines0 = []
-for filename in args.inputs:
-    filename = os.path.relpath(filename)
+        fatal('argument --rom-depth: depth must be positive')
+    if args.cache_dir and not os.path.isdir(args.cache_dir):
+        try:
+            os.makedirs(args.cache_dir)
+        except OSError:
+            if not os.path.isdir(args.cache_dir):
+                fatal('cannot create cache directory: ' + args.cache_dir)
+
+def read_source(name):
+    global filename
+    filename = os.path.relpath(name)
     if not os.path.isfile(filename):
         fatal('file does not exist: ' + filename)
+    lines0 = []
     with open(filename, 'r') as f:
         srcs[filename] = {}
         for pos, line in enumerate(f):
@@ -1016,68 +2157,126 @@ for filename in args.inputs:
             if line:
                 srcs[filename][pos + 1] = line
                 lines0.append((line, filename, pos + 1))
-if lines0:
-    lines0.append(('.align 4', lines0[-1][1], lines0[-1][2]))
-if args.f:
-    lines0.append(('.global ' + args.f, '_end', 0))
-    lines0.append((args.f + ':', '_end', 0))
-
-# 1. macro expansion
-lines1 = []
-if not args.r:
-    lines1 = [('mov', ['r29', start_label], '', 0), ('jr', ['r29', 'r29'], '', 0)]
-for line, filename, pos in lines0:
-    lines = expand_macro(line)
-    lines1.extend(map(lambda (x, y): (x, y, filename, pos), lines))
-if args.Wr29:
-    f = p = ''
-    for mnemonic, operands, filename, pos in lines1:
-        if 'r29' in operands and not (f == filename and p == pos):
-            f, p = filename, pos
-            warning('r29 is used', True)
-
-# 2. label resolution (by 2-pass algorithm)
-init_label_first(lines1)
-while args.O > 0 and optimize(lines1):
-    args.O -= 1
-    init_label(lines1)
-lines2 = resolve_label(lines1)
-for mnemonic, operands, filename, pos in lines1:
-    if mnemonic == '.global':
-        check_global(operands[0])
-    if mnemonic[-1] == ':' and not args.Wno_unused_label:
-        warn_unused_label(mnemonic[:-1])
-
-# 3. assemble
-if args.s or args.v:
-    with open(args.o + '.s', 'w') as f:
-        addr = entry_point
-        prev_pos = -1
-        prev_file = ''
-        for mnemonic, operands, filename, pos in lines2:
-            if prev_file != filename:
-                print >> f, '\n# file: ' + filename
-                prev_file = filename
-            s = '{:#08x}  {:7} {}'.format(addr, mnemonic, ', '.join(operands))
-            l = show_label(addr)
-            if args.v:
-                b = code(mnemonic, operands).ljust(4, '\0')[0:4]
-                comment = '# [{:08x}]  '.format(struct.unpack('<I', b)[0])
-                if l:
-                    comment += '(' + l + ')  '
-                if prev_pos != pos and filename:
-                    comment += srcs[filename][pos]
-                    prev_pos = pos
-            else:
-                comment = '# ' + l if l else ''
-            print >> f, '{:39} {}'.format(s, comment).rstrip()
-            addr += calc_ofs(mnemonic, operands)
+    return lines0
+
+# .rept n / .irp sym, value, ... blocks end with .endr. The body is
+# expanded once and copied, and labels declared in it get the suffix
+# $<line>$<copy> in every copy. \sym in an .irp body is replaced by each
+# value; register values share one expansion made with an unused register,
+# other values are expanded once per distinct value.
+block_mnemonics = ['.rept', '.irp', '.endr']
+
+def block_end(lines0, i):
+    depth = 0
+    for j in range(i, len(lines0)):
+        mnemonic = parse(lines0[j][0])[0] if lines0[j][0][0] == '.' else ''
+        if mnemonic in ['.rept', '.irp']:
+            depth += 1
+        elif mnemonic == '.endr':
+            depth -= 1
+            if depth == 0:
+                return j
+    error('{} without .endr'.format(parse(lines0[i][0])[0]))
+
+def copy_block(lines, k, subst={}):
+    names = set(m[:-1] for m, o, f, p in lines if m[-1] == ':')
+    names.update(o[0] for m, o, f, p in lines if m == '.set')
+    names = dict((name, '{}${}${}'.format(name, pos, k)) for name in names)
+    names.update(subst)
+    if not names:
+        return lines
+    def go(operand):
+        return re.sub(r'[\w.$!?]+', lambda m: names.get(m.group(), m.group()), operand)
+    return [(names[m[:-1]] + ':' if m[-1] == ':' else m, o if m == '.incbin' else map(go, o), f, p)
+            for m, o, f, p in lines]
 
-def write(f, byterepr):
-    if args.k:
-        f.write("{} => x\"{:08x}\",\n".format(i, struct.unpack('<I', byterepr)[0]))
-    elif args.a:
-        fmt = """
+def expand_block(mnemonic, operands, body):
+    global filename, pos
+    f, p = filename, pos
+    ret = []
+    if mnemonic == '.rept':
+        check_operands_n(operands, 1)
+        success, count = parse_int(operands[0])
+        if not success or count < 0:
+            error('expected non-negative integer literal: ' + operands[0])
+        lines = expand_lines(body)
+        filename, pos = f, p
+        for k in range(count):
+            ret.extend(copy_block(lines, k))
+        return ret
+    if not operands:
+        error('expected symbol name')
+    sym = operands[0]
+    if not re.match(r'\w+$', sym):
+        error('invalid symbol name: ' + sym)
+    def subst(value):
+        return [(re.sub(r'\\{}\b'.format(sym), lambda m: value, line), f0, p0) for line, f0, p0 in body]
+    used = set(regs[token] for line, f0, p0 in body for token in re.findall(r'\w+', line) if token in regs)
+    free = [reg for reg in ['r' + str(i) for i in range(1, 29)] if regs[reg] not in used]
+    expanded = {}
+    for k, value in enumerate(operands[1:]):
+        if value in regs and value not in ['r0', 'r29'] and free:
+            if free[0] not in expanded:
+                expanded[free[0]] = expand_lines(subst(free[0]))
+            lines = expanded[free[0]]
+            renames = {free[0]: value}
+        else:
+            if value not in expanded:
+                expanded[value] = expand_lines(subst(value))
+            lines = expanded[value]
+            renames = {}
+        filename, pos = f, p
+        ret.extend(copy_block(lines, k, renames))
+    return ret
+
+def expand_lines(lines0):
+    global filename, pos
+    lines1 = []
+    i = 0
+    while i < len(lines0):
+        line, filename, pos = lines0[i]
+        if line[0] == '.' and parse(line)[0] in block_mnemonics:
+            mnemonic, operands = parse(line)
+            if mnemonic == '.endr':
+                error('.endr without .rept or .irp')
+            end = block_end(lines0, i)
+            lines1.extend(expand_block(mnemonic, operands, lines0[i + 1:end]))
+            i = end + 1
+            continue
+        lines = expand_macro(line)
+        lines1.extend(map(lambda (x, y): (x, y, filename, pos), lines))
+        i += 1
+    return lines1
+
+# outputs are written to temporary files and renamed by commit_outputs(), so
+# that an error in the middle of streaming does not leave a truncated file
+def tmp_output(args, suffix):
+    return '{}{}.tmp{}'.format(args.o, suffix, os.getpid())
+
+def open_output(args, suffix, mode='w'):
+    output_suffixes.append(suffix)
+    return open(tmp_output(args, suffix), mode, 1 << 16)
+
+def commit_outputs(args):
+    for suffix in output_suffixes:
+        os.rename(tmp_output(args, suffix), args.o + suffix)
+
+def discard_outputs(args):
+    for suffix in output_suffixes:
+        try:
+            os.remove(tmp_output(args, suffix))
+        except OSError:
+            pass
+
+def write_chunked(f, lines, n=1 << 12):
+    lines = iter(lines)
+    while True:
+        chunk = ''.join(itertools.islice(lines, n))
+        if not chunk:
+            break
+        f.write(chunk)
+
+rs232c_fmt = """
         wait for BR; RS_RX <= '0';
         wait for BR; RS_RX <= '{}';
         wait for BR; RS_RX <= '{}';
@@ -1092,25 +2291,460 @@ def write(f, byterepr):
         wait for (2 * BR);
 
 """
-        for b in byterepr:
-            a = ord(b)
-            ps = ['1' if a & (1 << j) else '0' for j in range(8)]
-            f.write(fmt.format(*ps))
+rs232c_table = [rs232c_fmt.format(*['1' if a & (1 << j) else '0' for j in range(8)]) for a in range(256)]
+
+def write_rs232c(f, data):
+    write_chunked(f, itertools.imap(rs232c_table.__getitem__, bytearray(data)))
+
+def hex_words(data):
+    data += '\0' * (-len(data) & 3)
+    words = array.array('I', data)
+    if sys.byteorder == 'little':
+        words.byteswap()
+    data = binascii.hexlify(words.tostring())
+    return [data[i : i + 8] for i in xrange(0, len(data), 8)]
+
+def write_rom(f, args, words):
+    depth = args.rom_depth or len(words)
+    if args.rom_format == 'coe':
+        f.write('memory_initialization_radix=16;\nmemory_initialization_vector=\n')
+        write_chunked(f, itertools.imap('{},\n'.format, words[:-1]))
+        f.write('{};\n'.format(words[-1] if words else '00000000'))
+    elif args.rom_format == 'mif':
+        f.write('WIDTH=32;\nDEPTH={};\n\nADDRESS_RADIX=HEX;\nDATA_RADIX=HEX;\n\nCONTENT BEGIN\n'.format(max(depth, 1)))
+        write_chunked(f, itertools.imap('    {:x} : {};\n'.format, itertools.count(), words))
+        if len(words) < depth:
+            f.write('    [{:x}..{:x}] : 00000000;\n'.format(len(words), depth - 1))
+        f.write('END;\n')
     else:
-        f.write(byterepr)
+        write_chunked(f, itertools.imap('{} => x"{}",\n'.format, itertools.count(), words))
+        f.write("others => (others => '0')\n")
 
-with open(args.o, 'w') as f:
-    size = 0
-    if not (args.c or args.k):
-        write(f, 'size')
-    for i, (mnemonic, operands, filename, pos) in enumerate(lines2):
-        byterepr = code(mnemonic, operands)
-        write(f, byterepr)
-        size += len(byterepr)
+def write_image(args, image):
+    header = '' if args.c else ''.join(chr(len(image) >> x & 255) for x in [0, 8, 16, 24])
     if args.k:
-        f.write("others => (others => '0')\n")
-    elif not args.c:
-        f.seek(0)
-        byterepr = ''.join(chr(size >> x & 255) for x in [0, 8, 16, 24])
-        write(f, byterepr)
+        words = hex_words(image)
+        if not args.rom_depth:
+            with open_output(args, '') as f:
+                write_rom(f, args, words)
+            return
+        for bank, i in enumerate(xrange(0, max(len(words), 1), args.rom_depth)):
+            with open_output(args, '.{}'.format(bank)) as f:
+                write_rom(f, args, words[i : i + args.rom_depth])
+    elif args.a:
+        with open_output(args, '') as f:
+            write_rs232c(f, header + image)
+    else:
+        with open_output(args, '', 'wb') as f:
+            f.write(header)
+            f.write(image)
+
+# -k banks and -z packing need the whole image, other formats are written as
+# the instructions are encoded
+def start_image(args, size):
+    state = {'buf': [], 'buffered': 0, 'f': None}
+    if not (args.k or args.z):
+        state['f'] = open_output(args, '', 'w' if args.a else 'wb')
+        if not args.c:
+            write_part(args, state, ''.join(chr(size >> x & 255) for x in [0, 8, 16, 24]))
+    return state
+
+def write_part(args, state, data, chunk_size=1 << 14):
+    state['buf'].append(data)
+    state['buffered'] += len(data)
+    if state['f'] and state['buffered'] >= chunk_size:
+        flush_image(args, state)
+
+def flush_image(args, state):
+    data = ''.join(state['buf'])
+    state['buf'] = []
+    state['buffered'] = 0
+    if args.a:
+        write_rs232c(state['f'], data)
+    else:
+        state['f'].write(data)
+
+def finish_image(args, state):
+    if state['f']:
+        flush_image(args, state)
+        state['f'].close()
+        return
+    image = ''.join(state['buf'])
+    if args.z:
+        image = pack(image)
+        if args.send:
+            sender = start_send(args, len(image))
+            send(sender, image)
+            finish_send(sender)
+    write_image(args, image)
+
+# shared maps library file names to (srcs entry, preprocessed lines, expanded lines)
+def assemble(args, shared={}):
+    global filename, pos, tune_cost
+
+    # 0. preprocess
+    files = []
+    for name in args.inputs:
+        name = os.path.relpath(name)
+        if name in shared:
+            srcs[name] = shared[name][0]
+            files.append((name, shared[name][1]))
+        else:
+            files.append((name, read_source(name)))
+    lines0 = []
+    last = [lines for name, lines in files if lines]
+    if last:
+        lines0.append(('.align 4', last[-1][-1][1], last[-1][-1][2]))
+    if args.f:
+        lines0.append(('.global ' + args.f, '_end', 0))
+        lines0.append((args.f + ':', '_end', 0))
+
+    # 1. macro expansion
+    lines1 = []
+    if not args.r:
+        lines1 = [('mov', ['r29', start_label], '', 0), ('jr', ['r29', 'r29'], '', 0)]
+    for name, lines in files:
+        lines1.extend(shared[name][2] if name in shared else expand_lines(lines))
+    lines1.extend(expand_lines(lines0))
+    if args.Wr29:
+        f = p = ''
+        for mnemonic, operands, filename, pos in lines1:
+            if 'r29' in operands and not (f == filename and p == pos):
+                f, p = filename, pos
+                warning('r29 is used', True)
+
+    if args.gc_library:
+        lines1 = select_library(lines1, [(start_label, ''), (args.f, '')] if args.f else [(start_label, '')])
+    lines1 = layout_sections(lines1, args.page_color)
+    if args.function_order == 'refs':
+        lines1 = order_functions(lines1)
+    if args.align_loops:
+        lines1 = align_loops(lines1, args.align_loops)
+    if args.pool_data:
+        lines1 = pool_rodata(lines1)
+    else:
+        lines1 = [line for line in lines1 if line[0] != '.rodata']
+
+    # 2. label resolution (by 2-pass algorithm)
+    end = init_label_first(lines1)
+    while args.O > 0 and optimize(lines1):
+        args.O -= 1
+        end = init_label(lines1)
+    while relax_branches(lines1):
+        end = init_label(lines1)
+    if end - entry_point > 0x400000:
+        fatal('program size exceeds 4MB limit ({:,} bytes)'.format(end - entry_point))
+    bss = next((i for i, line in enumerate(lines1) if line[:2] == ('.section', ['bss'])), len(lines1))
+    bss_start = end
+    if bss < len(lines1):
+        bss_start = entry_point
+        for mnemonic, operands, filename, pos in lines1[:bss]:
+            bss_start += calc_ofs(mnemonic, operands, bss_start)
+    size = bss_start - entry_point
+
+    # 3. assemble (instructions are resolved, encoded and written one by one)
+    image = start_image(args, size)
+    sender = start_send(args, size) if args.send and not args.z else None
+    listing = open_output(args, '.s') if args.s or args.v else None
+    comments = label_comments() if listing else None
+    line_addrs = []
+    addr = entry_point
+    prev_pos = -1
+    prev_file = ''
+    for mnemonic, operands, filename, pos in resolve_label(lines1[:bss]):
+        byterepr = code(mnemonic, operands)
+        write_part(args, image, byterepr)
+        if sender:
+            send(sender, byterepr)
+        if listing:
+            if prev_file != filename:
+                listing.write('\n# file: ' + filename + '\n')
+                prev_file = filename
+            s = '%#08x  %-7s %s' % (addr, mnemonic, ', '.join(operands))
+            l = comments.get(addr)
+            if args.v:
+                comment = '# [' + byterepr[3::-1].rjust(4, '\0').encode('hex') + ']  '
+                if l:
+                    comment += '(' + l + ')  '
+                if prev_pos != pos and filename:
+                    comment += srcs[filename][pos]
+                    prev_pos = pos
+            else:
+                comment = '# ' + l if l else ''
+            listing.write(('%-39s %s' % (s, comment)).rstrip() + '\n')
+        if args.g and byterepr and (not line_addrs or line_addrs[-1][1:] != (filename, pos)):
+            line_addrs.append((addr, filename, pos))
+        addr += len(byterepr)
+    if addr != bss_start:
+        fatal('internal error: program size mismatch')
+    if sender:
+        finish_send(sender)
+    if listing:
+        if bss_start != end:
+            # the section starts after the padding in front of its first label
+            start = bss_start
+            for mnemonic, operands, filename, pos in lines1[bss:]:
+                if mnemonic not in ['.section', '.align', '.pgcolor', '.global', '.set']:
+                    break
+                start += calc_ofs(mnemonic, operands, start)
+            listing.write('\n# bss: {:#08x} - {:#08x} ({:,} bytes, not written)\n'.format(start, end, end - start))
+        if args.pool_data:
+            listing.write('\n# .rodata pool: {} blocks merged, {:,} bytes saved\n'.format(
+                pool_stats['merged'], pool_stats['saved']))
+        listing.close()
+
+    for mnemonic, operands, filename, pos in lines1:
+        if mnemonic == '.global':
+            check_global(operands[0])
+        if mnemonic[-1] == ':' and not args.Wno_unused_label:
+            warn_unused_label(mnemonic[:-1])
+
+    if args.g:
+        syms = sorted((labels[m[:-1]][fn][0], m[:-1]) for m, o, fn, p in lines1 if m[-1] == ':')
+        line_addrs.append((addr, '', 0))
+        with open_output(args, '.sym', 'wb') as f:
+            write_symbols(f, syms, line_addrs)
+
+    if tune_dir:
+        tune_cost = static_cost(lines1)
+    if args.cost_report:
+        with open_output(args, '.cost') as f:
+            write_cost_report(f, lines1, [] if args.r else [start_label])
+            if args.pool_data:
+                f.write('# .rodata pool: {} blocks merged, {:,} bytes saved\n'.format(
+                    pool_stats['merged'], pool_stats['saved']))
+
+    finish_image(args, image)
+
+def build(args, shared={}):
+    global warning_log, output_suffixes, incbin_files
+    warning_log = []
+    output_suffixes = []
+    incbin_files = set()
+    setup(args)
+    cache = cache_key(args) if args.cache_dir and not (args.send and (args.a or args.c or args.k)) else None
+    if cache and cache_fetch(args, cache):
+        if args.send:
+            with open(args.o, 'rb') as f:
+                image = f.read()
+            sender = start_send(args, len(image) - 4)
+            send(sender, image[4:])
+            finish_send(sender)
+        return
+    try:
+        assemble(args, shared)
+        commit_outputs(args)
+    except:
+        discard_outputs(args)
+        raise
+    if cache:
+        cache_store(args, cache)
+
+
+# ----------------------------------------------------------------------
+#       batch mode
+# ----------------------------------------------------------------------
+
+# Every line of the manifest holds the arguments of one job, e.g.
+# "-o fib.out fib.s" (empty lines and lines starting with '#' are skipped).
+# Options given on the command line apply to all jobs, and -l libraries
+# given there are read and expanded only once.
+
+batch_args = None
+batch_shared = {}
+
+def run_job(job):
+    global srcs
+    srcs = {}
+    stderr = sys.stderr
+    sys.stderr = StringIO.StringIO()
+    try:
+        args = argparser.parse_args(shlex.split(job, True), copy.deepcopy(batch_args))
+        build(args, batch_shared)
+        status = 0
+    except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else 1
+    except Exception:
+        traceback.print_exc()
+        status = 1
+    finally:
+        log = sys.stderr.getvalue()
+        sys.stderr = stderr
+    return status or 0, log
+
+def run_batch(args):
+    global batch_args, srcs
+    try:
+        with open(args.batch, 'r') as f:
+            jobs = [line.strip() for line in f]
+    except IOError:
+        fatal('cannot read batch file: ' + args.batch)
+    jobs = [job for job in jobs if job and job[0] != '#']
+    batch_args = copy.deepcopy(args)
+    batch_args.batch = None
+    batch_args.inputs = []
+    stderr = sys.stderr
+    for name in map(os.path.relpath, args.l or []):
+        srcs = {}
+        sys.stderr = StringIO.StringIO()
+        try:
+            lines0 = read_source(name)
+            batch_shared[name] = (srcs[name], lines0, expand_lines(lines0))
+        except SystemExit:
+            pass
+        finally:
+            sys.stderr = stderr
+    pool = multiprocessing.Pool(args.j or None)
+    failed = 0
+    try:
+        for job, (status, log) in zip(jobs, pool.imap(run_job, jobs)):
+            sys.stderr.write(log)
+            if status:
+                failed += 1
+                print >> sys.stderr, '{}: job failed: {}'.format(os.path.basename(sys.argv[0]), job)
+    finally:
+        pool.terminate()
+    if failed:
+        fatal('{} of {} jobs failed'.format(failed, len(jobs)))
+
+# ----------------------------------------------------------------------
+#       autotuning
+# ----------------------------------------------------------------------
+
+# --autotune assembles the program with every combination of the options
+# below in a process pool and builds the outputs with the best one. With
+# --tune-sim, candidates are scored by the number of executed instructions
+# (then by size) and must print the same output as the first candidate;
+# otherwise they are scored by the loop-weighted instruction count of
+# static_cost() (then by size), which ignores data and padding. Ties go to
+# the earlier candidate, so the choice is deterministic. The chosen options
+# and all scores are recorded in <file>.tune, which --tune-config reads to
+# build the same program again without tuning.
+
+tune_space = [
+    ('O', [0, 1, 2, 4]),
+    ('gc_library', [False, True]),
+    ('pool_data', [False, True]),
+    ('function_order', ['source', 'refs']),
+    ('align_loops', [0, 8, 16]),
+]
+tune_timeout = 60
+
+tune_args = None
+tune_dir = None
+tune_cost = None
+
+def apply_tune_config(args, path):
+    try:
+        with open(path, 'r') as f:
+            options = json.load(f)['options']
+    except (IOError, ValueError, KeyError, TypeError):
+        fatal('cannot read tuning configuration: ' + path)
+    if not isinstance(options, dict) or not set(options) <= set(key for key, values in tune_space):
+        fatal('invalid tuning configuration: ' + path)
+    for key, value in options.iteritems():
+        setattr(args, key, value)
+
+def run_sim(args):
+    with open(args.tune_input or os.devnull, 'rb') as f:
+        try:
+            proc = subprocess.Popen(shlex.split(args.tune_sim) + ['-stat', args.o],
+                                    stdin=f, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError:
+            fatal('cannot run simulator: ' + args.tune_sim)
+        timer = threading.Timer(tune_timeout, proc.kill)
+        timer.start()
+        try:
+            out, err = proc.communicate()
+        finally:
+            timer.cancel()
+    count = re.search(r'Number of executed instructions>?: *(\d+)', err)
+    if proc.returncode or not count or 'runtime error' in err:
+        print >> sys.stderr, err.rstrip()
+        fatal('simulation failed')
+    return int(count.group(1)), hashlib.sha1(out).hexdigest()
+
+def run_candidate(job):
+    global srcs
+    i, config = job
+    srcs = {}
+    stderr = sys.stderr
+    sys.stderr = StringIO.StringIO()
+    args = copy.deepcopy(tune_args)
+    for key, value in config.iteritems():
+        setattr(args, key, value)
+    args.o = os.path.join(tune_dir, '{}.out'.format(i))
+    score = output = None
+    try:
+        build(args)
+        size = os.path.getsize(args.o) - 4
+        if args.tune_sim:
+            count, output = run_sim(args)
+            score = [count, size]
+        else:
+            score = [tune_cost, size]
+    except SystemExit:
+        pass
+    except Exception:
+        traceback.print_exc()
+    finally:
+        log = sys.stderr.getvalue()
+        sys.stderr = stderr
+    if os.path.exists(args.o):
+        os.remove(args.o)
+    return score, output, log
+
+def run_autotune(args):
+    global tune_args, tune_dir
+    if args.tune_input and not os.access(args.tune_input, os.R_OK):
+        fatal('cannot read tuning input: ' + args.tune_input)
+    keys = [key for key, values in tune_space]
+    space = [values if key != 'gc_library' or args.l else [False] for key, values in tune_space]
+    configs = [dict(zip(keys, config)) for config in itertools.product(*space)]
+    tune_args = copy.deepcopy(args)
+    tune_args.autotune = False
+    tune_args.tune_config = None
+    tune_args.a = tune_args.c = tune_args.k = tune_args.s = tune_args.v = tune_args.g = False
+    tune_args.cost_report = False
+    tune_args.cache_dir = tune_args.send = None
+    tune_dir = tempfile.mkdtemp()
+    pool = multiprocessing.Pool(args.j or None)
+    try:
+        results = pool.map(run_candidate, list(enumerate(configs)))
+    finally:
+        pool.terminate()
+        shutil.rmtree(tune_dir, True)
+        tune_dir = None
+
+    done = [(config, score, output) for config, (score, output, log) in zip(configs, results) if score]
+    if not done:
+        sys.stderr.write(results[0][2])
+        fatal('no candidate could be built')
+    best = None
+    for config, score, output in done:
+        if output == done[0][2] and (best is None or score < best[1]):
+            best = (config, score)
+    best_args = copy.deepcopy(args)
+    best_args.autotune = False
+    best_args.tune_config = None
+    for key, value in best[0].iteritems():
+        setattr(best_args, key, value)
+    build(best_args)
+    with open(args.o + '.tune', 'w') as f:
+        json.dump({'options': best[0], 'score': best[1],
+                   'candidates': [[config, score] for config, (score, output, log) in zip(configs, results)]},
+                  f, indent=1, sort_keys=True)
+        f.write('\n')
+
+
+def main():
+    args = argparser.parse_args()
+    if args.batch:
+        run_batch(args)
+    elif args.autotune:
+        run_autotune(args)
+    else:
+        build(args)
 
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python2.7
+
+# Benchmark of the code generated by asm.py. Every program is assembled with
+# every variant below, run on the simulator, and the number of executed
+# instructions and the image size are written to the result file and
+# compared with the baseline.
+#
+#   $ make -C .. && ./bench.py             # compare with baseline.txt
+#   $ ./bench.py -u                        # accept the results as baseline
+
+import sys
+import os.path
+import shutil
+import tempfile
+import subprocess
+import threading
+import argparse
+
+
+def fatal(msg):
+    prog = os.path.basename(sys.argv[0])
+    if sys.stderr.isatty():
+        print >> sys.stderr, '\x1b[1m{}: \x1b[31mfatal error:\x1b[39m'.format(prog), msg
+        sys.stderr.write('\x1b[0m')
+    else:
+        print >> sys.stderr, '{}: fatal error:'.format(prog), msg
+    sys.exit(1)
+
+
+# ----------------------------------------------------------------------
+#       benchmarks
+# ----------------------------------------------------------------------
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+root_dir = os.path.dirname(bench_dir)
+test_dir = os.path.join(root_dir, 'test')
+
+# name, source files, library files, input, simulator options
+benchmarks = [
+    ('fib',  [os.path.join(test_dir, 'fib.s')], [os.path.join(test_dir, 'lib.s')], '\0\0\0\x16', ['-simple']),
+    ('tak',  [os.path.join(bench_dir, 'tak.s')], [os.path.join(test_dir, 'lib.s')], '', ['-simple']),
+    ('io',   [os.path.join(bench_dir, 'io.s')], [], ''.join(chr(i % 95 + 32) for i in range(1024)), ['-simple']),
+    ('fp',   [os.path.join(bench_dir, 'fp.s')], [os.path.join(test_dir, 'lib.s')], '', ['-simple']),
+    ('mmu',  [os.path.join(bench_dir, 'mmu.s')], [], '', []),
+    ('rodata', [os.path.join(bench_dir, 'rodata.s')], [os.path.join(test_dir, 'lib.s')], '', ['-simple']),
+]
+
+# name, asm.py options
+variants = [
+    ('O0',     ['-O0']),
+    ('O1',     ['-O1']),
+    ('O2',     ['-O2']),
+    ('gc',     ['-O2', '--gc-library']),
+    ('pool',   ['-O2', '--pool-data']),
+    ('packed', ['-O2', '-z']),
+]
+
+
+# ----------------------------------------------------------------------
+#       running
+# ----------------------------------------------------------------------
+
+def run(cmd, stdin=''):
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    timer = threading.Timer(args.timeout, proc.kill)
+    timer.start()
+    try:
+        out, err = proc.communicate(stdin)
+    finally:
+        timer.cancel()
+    return proc.returncode, out, err
+
+def first_error(err):
+    lines = [line for line in err.splitlines() if 'error' in line]
+    return (lines or err.splitlines() or [''])[0]
+
+def measure(tmp, name, files, libs, stdin, sim_opts, opts):
+    image = os.path.join(tmp, name + '.out')
+    cmd = [sys.executable, os.path.join(root_dir, 'asm.py'), '-Wno-unused-label', '-o', image]
+    for lib in libs:
+        cmd += ['-l', lib]
+    status, out, err = run(cmd + opts + files)
+    if status:
+        return None, None, 'assembly failed: ' + first_error(err)
+    size = os.path.getsize(image) - 4
+    status, out, err = run([args.sim, '-stat'] + sim_opts + [image], stdin)
+    count = [line.split(':')[1].strip() for line in err.splitlines() if 'Number of executed instructions' in line]
+    if status or not count or 'runtime error' in err:
+        return None, size, 'simulation failed: ' + first_error(err)
+    return int(count[0]), size, out
+
+def read_results(path):
+    results = {}
+    with open(path, 'r') as f:
+        for line in f:
+            if line.strip() and line[0] != '#':
+                name, variant, count, size = line.split()
+                results[name, variant] = int(count), int(size)
+    return results
+
+def delta(new, old):
+    if old is None:
+        return '{:>12}'.format('(new)')
+    return '{:>+12,} {:>+7.2f}%'.format(new - old, 100.0 * (new - old) / max(old, 1))
+
+
+# ----------------------------------------------------------------------
+#       main process
+# ----------------------------------------------------------------------
+
+argparser = argparse.ArgumentParser(usage='%(prog)s [options] [benchmark...]')
+argparser.add_argument('names', nargs='*', help='run only these benchmarks', metavar='benchmark...')
+argparser.add_argument('-b', help='compare with <file> (default: baseline.txt)', metavar='<file>',
+                       dest='baseline', default=os.path.join(bench_dir, 'baseline.txt'))
+argparser.add_argument('-o', help='write results to <file> (default: bench_output.txt)', metavar='<file>',
+                       dest='output', default=os.path.join(root_dir, 'bench_output.txt'))
+argparser.add_argument('-s', help='use simulator <file>', metavar='<file>', dest='sim', default=os.path.join(root_dir, 'sim'))
+argparser.add_argument('-t', help='kill each run after <integer> seconds', metavar='<integer>',
+                       dest='timeout', default=60, type=int)
+argparser.add_argument('-u', help='write results to the baseline file', action='store_true', dest='update')
+args = argparser.parse_args()
+
+if not os.path.isfile(args.sim):
+    fatal('simulator not found (run make first): ' + args.sim)
+unknown = set(args.names) - set(b[0] for b in benchmarks)
+if unknown:
+    fatal('unknown benchmark: ' + ', '.join(sorted(unknown)))
+baseline = read_results(args.baseline) if os.path.isfile(args.baseline) else {}
+
+tmp = tempfile.mkdtemp()
+results = []
+failed = regressed = 0
+try:
+    for name, files, libs, stdin, sim_opts in benchmarks:
+        if args.names and name not in args.names:
+            continue
+        expected = None
+        for variant, opts in variants:
+            count, size, out = measure(tmp, name, files, libs, stdin, sim_opts, opts)
+            if count is None:
+                print '{:<6} {:<7} FAILED: {}'.format(name, variant, out.rstrip())
+                failed += 1
+                continue
+            # every variant must behave like the first one
+            if expected is None:
+                expected = out
+            elif out != expected:
+                print '{:<6} {:<7} FAILED: output differs from {}'.format(name, variant, variants[0][0])
+                failed += 1
+                continue
+            old = baseline.get((name, variant), (None, None))
+            print '{:<6} {:<7} {:>12,} {} {:>9,} {}'.format(name, variant, count, delta(count, old[0]),
+                                                           size, delta(size, old[1]))
+            if old[0] is not None and (count > old[0] or size > old[1]):
+                regressed += 1
+            results.append((name, variant, count, size))
+finally:
+    shutil.rmtree(tmp, True)
+
+def write_results(path, results):
+    with open(path, 'w') as f:
+        f.write('# benchmark variant instructions size\n')
+        for result in results:
+            f.write('{} {} {} {}\n'.format(*result))
+
+write_results(args.output, results)
+if args.update:
+    # keep the baseline of benchmarks which were not run
+    for name, variant, count, size in results:
+        baseline[name, variant] = count, size
+    order = dict((key, i) for i, key in enumerate((b[0], v[0]) for b in benchmarks for v in variants))
+    write_results(args.baseline, [key + value for key, value in sorted(baseline.iteritems(),
+                                                                        key=lambda (k, v): order.get(k, len(order)))])
+
+if failed:
+    fatal('{} runs failed'.format(failed))
+if regressed and not args.update:
+    fatal('{} runs regressed against {}'.format(regressed, os.path.relpath(args.baseline)))
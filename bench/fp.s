@@ -0,0 +1,25 @@
+# floating point kernel: 1000 * sum of 1 / sqrt(i) for i = 1 .. 2000,
+# computed with fsqrt, finv and fmul, and one Newton step on each inverse
+# -l ../test/lib.s
+
+.global main
+main:
+    mov     r5, 1
+    mov     r6, 0
+    mov     r7, 2000
+    mov     r8, 2.0
+loop:
+    itof    r1, r5
+    fsqrt   r2, r1
+    finv    r3, r2
+    fmul    r4, r2, r3          # Newton step: r3 = r3 * (2 - r2 * r3)
+    fsub    r4, r8, r4
+    fmul    r3, r3, r4
+    fadd    r6, r6, r3
+    add     r5, r5, 1
+    ble     r5, r7, loop
+    mov     r4, 1000.0
+    fmul    r6, r6, r4
+    ftoi    r1, r6
+    call    print_int
+    halt
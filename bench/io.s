@@ -0,0 +1,37 @@
+# serial I/O: print messages from memory, then echo 1024 bytes with the
+# case bit flipped
+# -l ../test/lib.s
+
+puts:
+    ldb     r2, r1, 0
+    bz      r2, puts_ret
+    write   r2
+    add     r1, r1, 1
+    br      puts
+puts_ret:
+    ret
+
+.global main
+main:
+    mov     r1, hello
+    call    puts
+    mov     r5, 1024
+echo:
+    read    r1
+    xor     r1, r1, 32
+    write   r1
+    sub     r5, r5, 1
+    bnz     r5, echo
+    mov     r1, bye
+    call    puts
+    mov     r1, again
+    call    puts
+    halt
+
+.rodata
+hello:
+    .string "hello, serial\n"
+bye:
+    .string "bye, serial\n"
+again:
+    .string "hello, serial\n"
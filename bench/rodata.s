@@ -0,0 +1,44 @@
+# .rodata layout: sums the tables below 100 times. With --pool-data the
+# duplicate tables are merged, and tbl keeps its .int at tbl+4 behind the
+# .align that follows its bytes.
+# -l ../test/lib.s
+
+.global main
+main:
+    mov     r5, 0
+    mov     r6, 100
+loop:
+    mov     r1, tbl
+    ldb     r2, r1, 2
+    ld      r3, r1, 4
+    add     r5, r5, r2
+    add     r5, r5, r3
+    mov     r1, [other]
+    add     r5, r5, r1
+    mov     r1, [same]
+    add     r5, r5, r1
+    mov     r1, msg
+    ldb     r2, r1, 0
+    add     r5, r5, r2
+    mov     r1, tail
+    ldb     r2, r1, 1
+    add     r5, r5, r2
+    sub     r6, r6, 1
+    bnz     r6, loop
+    add     r1, r5, 0
+    call    print_int
+    halt
+
+.rodata
+tbl:
+    .byte   1, 2, 3
+    .align  4
+    .int    0x1234
+other:
+    .int    7
+same:
+    .int    7
+msg:
+    .string "pool"
+tail:
+    .string "ol"
@@ -0,0 +1,41 @@
+# call-heavy recursion: tak(18, 12, 6) = 7
+# -l ../test/lib.s
+
+tak:
+    enter   20
+    bge     r2, r1, tak_ret
+    mov     [rbp - 4], r1
+    mov     [rbp - 8], r2
+    mov     [rbp - 12], r3
+    sub     r1, r1, 1
+    call    tak                 # tak(x - 1, y, z)
+    mov     [rbp - 16], r1
+    mov     r1, [rbp - 8]
+    sub     r1, r1, 1
+    mov     r2, [rbp - 12]
+    mov     r3, [rbp - 4]
+    call    tak                 # tak(y - 1, z, x)
+    mov     [rbp - 20], r1
+    mov     r1, [rbp - 12]
+    sub     r1, r1, 1
+    mov     r2, [rbp - 4]
+    mov     r3, [rbp - 8]
+    call    tak                 # tak(z - 1, x, y)
+    mov     r3, r1
+    mov     r1, [rbp - 16]
+    mov     r2, [rbp - 20]
+    call    tak
+    leave
+    ret
+tak_ret:
+    mov     r1, r3
+    ret
+
+.global main
+main:
+    mov     r1, 18
+    mov     r2, 12
+    mov     r3, 6
+    call    tak
+    call    print_int
+    halt
@@ -24,6 +24,7 @@ void error(char*, ...);
 //for debug func
 static int is_indebug = 0;
 void print_disasm(FILE*, uint32_t);
+void print_symbol(FILE*, uint32_t);
 void dump_e_i();
 void update_e_i(uint32_t, uint32_t);
 int is_break_disabled(int);
@@ -34,6 +35,12 @@ void enable_break_all();
 
 int break_disabled[8];
 
+// symbol file written by "asm.py -g"
+static uint32_t *sym_file;
+static uint32_t sym_num, line_num;
+static uint32_t *sym_table, *line_table;
+static char *sym_strs;
+
 void exec_debug(int tag, int lit)
 {
   if (!debug_enabled)
@@ -107,6 +114,7 @@ void do_interactive_loop()
         count = 10;
       for (i = 0; i < count; i++) {
         fprintf(stderr, "0x%08x: ", pc + i * 4);
+        print_symbol(stderr, pc + i * 4);
         print_disasm(stderr, mem[to_physical(pc + i * 4) >> 2]);
       }
 
@@ -161,6 +169,7 @@ void debug_hook()
     restore_term();
 
     fprintf(stderr, "0x%08x: ", pc);
+    print_symbol(stderr, pc);
     print_disasm(stderr, mem[phys_pc >> 2]);
     do_interactive_loop();
 
@@ -208,6 +217,7 @@ void dump_e_i(){
   fprintf(stderr, "  address  |    code    |      assembly\n");
   for(i=0; i<CRASH_TRACE_NUM; i++){
     fprintf(stderr, "0x%08x | 0x%08x | ", e_inst_loc[i], e_inst[i]);
+    print_symbol(stderr, e_inst_loc[i]);
     print_disasm(stderr, e_inst[i]);
   }
 }
@@ -221,6 +231,63 @@ void update_e_i(uint32_t pc, uint32_t now_i){
   e_inst_loc[0] = pc;
 }
 
+//
+// symbols
+//
+void load_symbols(char *path)
+{
+  FILE *fp;
+  long size;
+
+  if ((fp = fopen(path, "rb")) == NULL)
+    error("load_symbols: cannot open %s", path);
+  fseek(fp, 0, SEEK_END);
+  size = ftell(fp);
+  fseek(fp, 0, SEEK_SET);
+  sym_file = malloc(size);
+  if (size < 20 || fread(sym_file, 1, size, fp) != (size_t)size || memcmp(sym_file, "GSYM", 4) != 0)
+    error("load_symbols: invalid symbol file: %s", path);
+  fclose(fp);
+
+  sym_num = sym_file[2];
+  line_num = sym_file[3];
+  sym_table = sym_file + 5;
+  line_table = sym_table + 2 * sym_num;
+  sym_strs = (char *)(line_table + 3 * line_num);
+  if ((char *)sym_strs + sym_file[4] != (char *)sym_file + size)
+    error("load_symbols: invalid symbol file: %s", path);
+}
+
+// index of the last entry whose address is not greater than addr, or -1
+static int bsearch_addr(uint32_t *table, uint32_t num, int stride, uint32_t addr)
+{
+  int lo = 0, hi = num;
+  while (lo < hi) {
+    int mid = (lo + hi) / 2;
+    if (table[mid * stride] <= addr)
+      lo = mid + 1;
+    else
+      hi = mid;
+  }
+  return lo - 1;
+}
+
+void print_symbol(FILE *fp, uint32_t addr)
+{
+  int i;
+
+  if (sym_file == NULL)
+    return;
+  if ((i = bsearch_addr(sym_table, sym_num, 2, addr)) >= 0) {
+    if (addr == sym_table[2 * i])
+      fprintf(fp, "<%s> ", sym_strs + sym_table[2 * i + 1]);
+    else
+      fprintf(fp, "<%s+%#x> ", sym_strs + sym_table[2 * i + 1], addr - sym_table[2 * i]);
+  }
+  if ((i = bsearch_addr(line_table, line_num, 3, addr)) >= 0 && sym_strs[line_table[3 * i + 1]] != '\0')
+    fprintf(fp, "%s:%d ", sym_strs + line_table[3 * i + 1], line_table[3 * i + 2]);
+}
+
 //
 // disasm
 //
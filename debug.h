@@ -1,6 +1,7 @@
 void debug_hook();
 void dump_e_i();
 void exec_debug(int, int);
+void load_symbols(char *);
 
 // opcode constants
 #define OP_BREAK  1
@@ -0,0 +1,121 @@
+#!/usr/bin/env python2.7
+
+import sys
+import os.path
+import re
+import bisect
+import struct
+import argparse
+
+
+def fatal(msg):
+    prog = os.path.basename(sys.argv[0])
+    if sys.stderr.isatty():
+        print >> sys.stderr, '\x1b[1m{}: \x1b[31mfatal error:\x1b[39m'.format(prog), msg
+        sys.stderr.write('\x1b[0m')
+    else:
+        print >> sys.stderr, '{}: fatal error:'.format(prog), msg
+    sys.exit(1)
+
+
+# ----------------------------------------------------------------------
+#       input files
+# ----------------------------------------------------------------------
+
+# see write_symbols() in asm.py for the layout
+def read_symbols(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) < 20 or data[:4] != 'GSYM':
+        fatal('invalid symbol file: ' + path)
+    version, nsyms, nlines, strsize = struct.unpack_from('<IIII', data, 4)
+    line_ofs = 20 + 8 * nsyms
+    strs = data[line_ofs + 12 * nlines:]
+    if version != 1 or len(strs) != strsize:
+        fatal('invalid symbol file: ' + path)
+    def name(ofs):
+        return strs[ofs:strs.index('\0', ofs)]
+    syms = [struct.unpack_from('<II', data, 20 + 8 * i) for i in xrange(nsyms)]
+    syms = [(addr, name(ofs)) for addr, ofs in syms]
+    lines = [struct.unpack_from('<III', data, line_ofs + 12 * i) for i in xrange(nlines)]
+    lines = [(addr, name(ofs), line) for addr, ofs, line in lines]
+    return syms, lines
+
+def read_counts(path):
+    counts = []
+    with open(path, 'r') as f:
+        for line in f:
+            addr, count = line.split()
+            counts.append((int(addr, 16), int(count)))
+    return counts
+
+srcs = {}
+
+def source_line(filename, pos):
+    if filename not in srcs:
+        srcs[filename] = {}
+        path = os.path.join(args.root, filename)
+        if os.path.isfile(path):
+            with open(path, 'r') as f:
+                for i, line in enumerate(f):
+                    srcs[filename][i + 1] = line.strip()
+    return srcs[filename].get(pos, '')
+
+def macro_name(filename, pos):
+    if not filename:
+        return '(startup)'
+    m = re.match(r'[^\s#]+', source_line(filename, pos))
+    return m.group() if m else '(unknown)'
+
+
+# ----------------------------------------------------------------------
+#       main process
+# ----------------------------------------------------------------------
+
+argparser = argparse.ArgumentParser(usage='%(prog)s [options] symfile countfile')
+argparser.add_argument('symfile', help='symbol file generated by asm.py -g')
+argparser.add_argument('countfile', help='execution count file generated by sim -prof')
+argparser.add_argument('-c', help='output collapsed stacks for flame graphs to <file>', metavar='<file>')
+argparser.add_argument('-n', help='show top <integer> entries of each table', metavar='<integer>', default=20, type=int)
+argparser.add_argument('-r', help='look up source files under <dir>', metavar='<dir>', dest='root', default='.')
+args = argparser.parse_args()
+
+syms, lines = read_symbols(args.symfile)
+sym_addrs = [addr for addr, name in syms]
+line_addrs = [addr for addr, filename, pos in lines]
+
+by_label = {}
+by_line = {}
+by_macro = {}
+stacks = {}
+total = 0
+for addr, count in read_counts(args.countfile):
+    i = bisect.bisect_right(sym_addrs, addr) - 1
+    label = syms[i][1] if i >= 0 else '(none)'
+    i = bisect.bisect_right(line_addrs, addr) - 1
+    filename, pos = lines[i][1:] if i >= 0 else ('', 0)
+    macro = macro_name(filename, pos)
+    by_label[label] = by_label.get(label, 0) + count
+    by_line[filename, pos] = by_line.get((filename, pos), 0) + count
+    by_macro[macro] = by_macro.get(macro, 0) + count
+    key = '{};{};{}:{}'.format(label, macro, filename, pos) if filename else '{};{}'.format(label, macro)
+    stacks[key] = stacks.get(key, 0) + count
+    total += count
+
+def show(title, table, fmt):
+    print '# {}'.format(title)
+    for key, count in sorted(table.iteritems(), key=lambda (k, v): (-v, k))[:args.n]:
+        print '{:>14,} {:6.2f}%  {}'.format(count, 100.0 * count / max(total, 1), fmt(key))
+    print
+
+print '# total: {:,} instructions'.format(total)
+print
+show('labels', by_label, lambda label: label)
+show('macros', by_macro, lambda macro: macro)
+show('source lines', by_line, lambda (filename, pos): '{}:{}  {}'.format(filename, pos, source_line(filename, pos))
+                                                      if filename else '(startup)')
+
+if args.c:
+    with open(args.c, 'w', 1 << 16) as f:
+        for key, count in sorted(stacks.iteritems()):
+            f.write('{} {}\n'.format(key, count))
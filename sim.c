@@ -34,10 +34,14 @@ long long inst_cnt;
 struct termios original_ttystate;
 
 char infile[128];
+char symfile[128];
+char proffile[128];
+uint64_t *prof_cnt;
 int show_stat, boot_test, sim_intr_disabled, use_maswag_fpu;
 
 uint32_t to_physical(uint32_t);
 void restore_term();
+void dump_profile();
 
 void print_env(int show_vpc)
 {
@@ -69,6 +73,7 @@ void error(char *fmt, ...)
     print_env(strncmp("to_physical: ", fmt, strlen("to_physical: ")));
     restore_term();
     dump_e_i();
+    dump_profile();
     va_end(ap);
     exit(1);
 }
@@ -396,6 +401,28 @@ void init_env()
     pc = entry_point;
     inst_cnt = 0;
     irq_bits = 0;
+    if (proffile[0] != '\0') {
+        free(prof_cnt);
+        prof_cnt = calloc(mem_size >> 2, sizeof(uint64_t));
+    }
+}
+
+// write "address count" lines for every executed (physical) address
+void dump_profile()
+{
+    FILE *fp;
+    if (prof_cnt == NULL)
+        return;
+    if ((fp = fopen(proffile, "w")) == NULL) {
+        fprintf(stderr, "dump_profile: %s: %s\n", proffile, strerror(errno));
+        return;
+    }
+    for (uint32_t i = 0; i < mem_size >> 2; ++i)
+        if (prof_cnt[i])
+            fprintf(fp, "%08x %llu\n", i << 2, (unsigned long long)prof_cnt[i]);
+    fclose(fp);
+    free(prof_cnt);
+    prof_cnt = NULL;
 }
 
 void init_term()
@@ -457,6 +484,8 @@ void runsim()
             error("program counter out of range");
         if (mem[phys_pc >> 2] == HALT_CODE)
             break;
+        if (prof_cnt)
+            ++prof_cnt[phys_pc >> 2];
         exec(mem[phys_pc >> 2]);
         pc += 4;
         ++inst_cnt;
@@ -472,8 +501,10 @@ void print_help(char *prog)
     fprintf(stderr, "  -fpu-maswag       use MasWag's FPU\n");
     fprintf(stderr, "  -msize <integer>  change memory size (MB)\n");
     fprintf(stderr, "  -no-interrupt     disable interrupt feature\n");
+    fprintf(stderr, "  -prof <file>      write execution count of each address to <file>\n");
     fprintf(stderr, "  -simple           same as -no-interrupt\n");
     fprintf(stderr, "  -stat             show simulator status\n");
+    fprintf(stderr, "  -sym <file>       load symbol file generated by asm.py -g\n");
     exit(1);
 }
 
@@ -492,10 +523,16 @@ void parse_cmd(int argc, char *argv[])
             mem_size = atoi(argv[++i]) << 20;
         } else if (strcmp(argv[i], "-no-interrupt") == 0) {
             sim_intr_disabled = 1;
+        } else if (strcmp(argv[i], "-prof") == 0) {
+            if (i == argc - 1) print_help(argv[0]);
+            strcpy(proffile, argv[++i]);
         } else if (strcmp(argv[i], "-simple") == 0) {
             sim_intr_disabled = 1;
         } else if (strcmp(argv[i], "-stat") == 0) {
             show_stat = 1;
+        } else if (strcmp(argv[i], "-sym") == 0) {
+            if (i == argc - 1) print_help(argv[0]);
+            strcpy(symfile, argv[++i]);
         } else if (infile[0] != '\0') {
             fprintf(stderr, "error: multiple input files are specified\n");
             print_help(argv[0]);
@@ -509,8 +546,10 @@ int main(int argc, char *argv[])
 {
     parse_cmd(argc, argv);
     if (infile[0] == '\0') print_help(argv[0]);
+    if (symfile[0] != '\0') load_symbols(symfile);
     init_term();
     runsim();
+    dump_profile();
     if (show_stat) {
         print_env(1);
         dump_e_i();
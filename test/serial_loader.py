@@ -0,0 +1,48 @@
+#!/usr/bin/env python2.7
+
+# Stand-in for bootloader.s on a local pseudo terminal, for testing
+# "asm.py --send". It prints the name of the tty to send to, receives the
+# 4-byte size header and the program, echoes the same progress messages as
+# the bootloader and saves what it received in the format of asm.py output.
+#
+#   $ ./serial_loader.py received.out &
+#   $ ../asm.py --send /dev/pts/N fib.s -l lib.s && cmp a.out received.out
+
+import sys
+import os
+import pty
+import tty
+import select
+
+if len(sys.argv) != 2:
+    print >> sys.stderr, 'usage: {} output'.format(sys.argv[0])
+    sys.exit(1)
+
+master, slave = pty.openpty()
+tty.setraw(master)
+print os.ttyname(slave)
+sys.stdout.flush()
+
+# like the real serial port, drop messages nobody reads instead of blocking
+def write(msg):
+    if select.select([], [master], [], 0)[1]:
+        os.write(master, msg)
+
+def read(n):
+    data = []
+    while n > 0:
+        data.append(os.read(master, min(n, 1 << 16)))
+        n -= len(data[-1])
+    return ''.join(data)
+
+write('\r\nGAIA Architecture\r\n\r\nWaiting for input...\r\n')
+header = read(4)
+size = sum(ord(c) << (8 * i) for i, c in enumerate(header))
+data = []
+for ofs in xrange(0, size, 1024):
+    write('\rLoading... [{} KB / {} KB]'.format(ofs >> 10, (size + 1023) >> 10))
+    data.append(read(min(1024, size - ofs)))
+write('\rLoading completed!              \r\n\r\n')
+with open(sys.argv[1], 'wb') as f:
+    f.write(header + ''.join(data))
+print >> sys.stderr, 'received {:,} bytes'.format(size)